@@ -1,7 +1,7 @@
 import os
 import shutil
+import threading
 from datetime import datetime
-from pymongo import MongoClient
 from bson import ObjectId
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv 
@@ -19,13 +19,18 @@ from flask import (
     session,
 )
 
+from mongo import get_db, ensure_indexes, migrate_tracks_schema
+from services import metrics
 from controllers.mezcla_controller import (
     mezcla_bp,
     index as mezclador_index,
     mezclar,
     exportar,
-    MIX_NAME as MIX_FINAL_NAME,
+    mix_actual,
+    SERVICES_AVAILABLE,
 )
+if SERVICES_AVAILABLE:
+    from services import similarity_service, waveform_service, export_service, blob_store, mix_cache
 
 # --- Configuración de la Aplicación ---
 app = Flask(__name__)
@@ -43,11 +48,31 @@ MONGO_DB_NAME = os.getenv("MONGO_DB")
 if not MONGO_URL or not MONGO_DB_NAME:
     raise ValueError("No se encontraron las variables de entorno MONGO_URL o MONGO_DB. Asegúrate de que tu archivo .env está configurado correctamente.")
 
-client = MongoClient(MONGO_URL)
-db = client[MONGO_DB_NAME]
-users_collection = db.users
-tracks_collection = db.tracks
-mixes_collection = db.mixes
+# Cliente compartido y seguro tras fork (ver mongo.py); las colecciones se piden en cada uso.
+# Índices: MONGO_ENSURE_INDEXES=1 los verifica al arrancar.
+# Esquema de 'tracks': las consultas sólo usan userId/storedName/uploadedAt, así que las pistas antiguas
+# de /upload se migran solas al arrancar (idempotente; en segundo plano para no retrasar el arranque).
+# MONGO_MIGRATE=0 lo desactiva cuando ya se ha ejecutado `python mongo.py migrate`.
+def _migrar_esquema_tracks():
+    try:
+        migradas = migrate_tracks_schema()
+        if migradas:
+            print(f"Pistas migradas al esquema unificado: {migradas}")
+    except Exception as e:
+        print(f"No se pudo migrar el esquema de pistas: {e}")
+
+if os.getenv("MONGO_MIGRATE") != "0":
+    threading.Thread(target=_migrar_esquema_tracks, name="migrate-tracks", daemon=True).start()
+
+if os.getenv("MONGO_ENSURE_INDEXES") == "1":
+    try:
+        for coll, name, problem in ensure_indexes():
+            print(f"Índice {coll}.{name}: {problem}")
+    except Exception as e:
+        print(f"No se pudieron verificar los índices: {e}")
+
+# --- Métricas: tiempos por endpoint y etapa en GET /metrics, traza con `touch trace.on` ---
+metrics.init_app(app)
 
 # --- Registro del Blueprint ---
 app.register_blueprint(mezcla_bp)
@@ -81,11 +106,11 @@ def register():
         usuario = request.form["usuario"]
         password = request.form["password"]
 
-        if users_collection.find_one({"usuario": usuario}):
+        if get_db().users.find_one({"usuario": usuario}):
             flash("Ese nombre de usuario ya existe", "warning")
             return redirect(url_for("register"))
 
-        users_collection.insert_one({"usuario": usuario, "password": password})
+        get_db().users.insert_one({"usuario": usuario, "password": password})
         flash("Usuario registrado con éxito. Ahora puedes iniciar sesión.", "success")
         return redirect(url_for("login"))
 
@@ -99,7 +124,7 @@ def login():
         usuario = request.form["usuario"]
         password = request.form["password"]
 
-        user = users_collection.find_one({"usuario": usuario, "password": password})
+        user = get_db().users.find_one({"usuario": usuario, "password": password})
 
         if user:
             session["usuario"] = user["usuario"]
@@ -135,7 +160,7 @@ def dashboard():
     if not user_id:
         return redirect(url_for("login"))
 
-    user_mixes = list(mixes_collection.find({"user_id": user_id}).sort("created_at", -1).limit(8))
+    user_mixes = list(get_db().mixes.find({"user_id": user_id}).sort("created_at", -1).limit(8))
     
     mezclas_para_template = [
         {
@@ -161,7 +186,7 @@ def pistas():
     if not user_id:
         return redirect(url_for("login"))
 
-    user_tracks = list(tracks_collection.find({"user_id": user_id}).sort("created_at", -1))
+    user_tracks = list(get_db().tracks.find({"userId": user_id}).sort("uploadedAt", -1))
     
     for track in user_tracks:
         track["id"] = str(track["_id"])
@@ -189,19 +214,29 @@ def upload():
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
+            # Nunca se escribe sobre el archivo existente: puede ser un enlace a un blob compartido
+            file.save(filepath + ".part")
+            os.replace(filepath + ".part", filepath)
+            file_hash = None
+            if SERVICES_AVAILABLE:
+                file_hash = mix_cache.file_sha256(filepath)
+                blob_store.adopt(app.config['UPLOAD_FOLDER'], filepath, file_hash)
 
             user_id = _user_id_from_session()
             track_data = {
-                "user_id": user_id,
-                "filename": filename,
+                "userId": user_id,
+                "storedName": filename,
+                "originalName": file.filename,
                 "name": os.path.splitext(filename)[0],
                 "url": url_for('static', filename=f'uploads/{filename}'),
                 "ext": filename.rsplit(".", 1)[1].lower(),
                 "size": f"{os.path.getsize(filepath) / 1024 / 1024:.2f} MB",
-                "created_at": datetime.utcnow()
+                "contentHash": file_hash,  # no "sha256": aquí se permite resubir el mismo contenido
+                "uploadedAt": datetime.utcnow()
             }
-            tracks_collection.insert_one(track_data)
+            get_db().tracks.insert_one(track_data)
+            if SERVICES_AVAILABLE:
+                waveform_service.generate_peaks_async(filepath)
 
             flash(f'Pista "{filename}" subida con éxito.', 'success')
             return redirect(url_for('pistas'))
@@ -219,15 +254,24 @@ def delete_track(track_id):
         return redirect(url_for("login"))
 
     user_id = _user_id_from_session()
-    track_to_delete = tracks_collection.find_one({"_id": ObjectId(track_id), "user_id": user_id})
+    track_to_delete = get_db().tracks.find_one({"_id": ObjectId(track_id), "userId": user_id})
 
     if track_to_delete:
         try:
-            filepath = os.path.join(app.config["UPLOAD_FOLDER"], track_to_delete["filename"])
+            filepath = os.path.join(app.config["UPLOAD_FOLDER"], track_to_delete["storedName"])
             if os.path.exists(filepath):
                 os.remove(filepath)
-
-            tracks_collection.delete_one({"_id": ObjectId(track_id)})
+            if SERVICES_AVAILABLE:
+                waveform_service.remove_peaks(filepath)
+                # Si era el último nombre de ese contenido, el blob se libera ya (si no, lo hará el GC)
+                content_hash = track_to_delete.get("sha256") or track_to_delete.get("contentHash")
+                if content_hash:
+                    blob_store.collect(app.config["UPLOAD_FOLDER"], content_hash)
+
+            get_db().tracks.delete_one({"_id": ObjectId(track_id)})
+            get_db().trackFeatures.delete_one({"trackId": ObjectId(track_id)})
+            if SERVICES_AVAILABLE:
+                similarity_service.track_removed(user_id, ObjectId(track_id))
             flash("Pista eliminada correctamente.", "success")
 
         except Exception as e:
@@ -275,24 +319,40 @@ def guardar_mezcla():
         flash("No pude identificar tu usuario. Inicia sesión de nuevo.", "error")
         return redirect(url_for("login"))
 
-    final_mix_path = os.path.join(app.config["UPLOAD_FOLDER"], MIX_FINAL_NAME)
-    if not os.path.exists(final_mix_path):
+    final_mix_name = mix_actual(app.config["UPLOAD_FOLDER"])
+    if not final_mix_name:
         flash("Aún no hay una mezcla final para guardar. Genera una primero.", "warning")
         return redirect(url_for("dashboard"))
 
     try:
+        # Formato opcional del formulario (mp3 por defecto); el transcode sale de la caché de exportación
+        fmt, quality = "mp3", None
+        if SERVICES_AVAILABLE:
+            fmt, quality = export_service.resolve(request.form.get("formato"), request.form.get("calidad"))
+            final_mix_name = export_service.export(app.config["UPLOAD_FOLDER"], final_mix_name, fmt, quality)
         ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        new_filename = f"mix_{user_id}_{ts}.mp3"
-        dest_path = os.path.join(app.config["UPLOAD_FOLDER"], new_filename)
-        shutil.copyfile(final_mix_path, dest_path)
+        new_filename = f"mix_{user_id}_{ts}{os.path.splitext(final_mix_name)[1]}"
+        src_path = os.path.join(app.config["UPLOAD_FOLDER"], final_mix_name)
+        mix_hash = None
+        if SERVICES_AVAILABLE:
+            # Enlace al blob del contenido (O(1) si ya estaba guardado). MIX_NAME se reescribe en su
+            # mismo inodo en cada mezcla, así que su blob se crea copiando; cache/ y jobs/ no cambian.
+            mix_hash = mix_cache.file_sha256(src_path)
+            blob_store.link(app.config["UPLOAD_FOLDER"], mix_hash, new_filename, source=src_path,
+                            copy=not final_mix_name.startswith(("cache/", "jobs/")))
+        else:
+            shutil.copyfile(src_path, os.path.join(app.config["UPLOAD_FOLDER"], new_filename))
 
         mix_data = {
             "user_id": user_id,
             "name": f"Mix {ts}",
             "filepath": url_for('static', filename=f'uploads/{new_filename}'),
+            "format": fmt,
+            "quality": quality,
+            "sha256": mix_hash,
             "created_at": datetime.utcnow()
         }
-        mixes_collection.insert_one(mix_data)
+        get_db().mixes.insert_one(mix_data)
         flash("Mezcla guardada en tu panel.", "success")
 
     except Exception as e:
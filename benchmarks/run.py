@@ -0,0 +1,189 @@
+# benchmarks/run.py
+"""
+Benchmarks de las rutas calientes (hash, análisis, mezcla) sobre audio sintético determinista.
+
+    python -m benchmarks.run                  # mide y compara con benchmarks/baseline.json
+    python -m benchmarks.run --check          # además sale con código 1 si hay regresión
+    python -m benchmarks.run --update         # guarda los resultados como nueva línea base
+    python -m benchmarks.run --only features  # sólo las etapas cuyo nombre contiene "features"
+
+Cada etapa informa del tiempo (mínimo de --repeat ejecuciones), el rendimiento (x tiempo real o MB/s)
+y la memoria pico de Python (tracemalloc, en una ejecución aparte para no falsear el tiempo).
+Como el tempo y la tonalidad de las entradas son conocidos, también se comprueba que BPM y key
+no cambian respecto a la línea base: una optimización no debe alterar el resultado del análisis.
+La línea base es de la máquina donde se generó; en otra máquina, regenerarla antes de comparar.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import synth
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# Margen de tiempo antes de considerar una etapa más lenta como regresión
+TIME_TOLERANCE = 0.30
+# Diferencias absolutas menores que esto son ruido (etapas de milisegundos)
+MIN_DELTA_SEC = 0.05
+BPM_TOLERANCE = 0.5
+
+# (archivo, bpm, tonalidad, segundos)
+CASES = [
+    ("click124_A_30s.wav", 124, "A", 30),
+    ("click96_D_30s.flac", 96, "D", 30),
+    ("click140_Fs_180s.wav", 140, "F#", 180),
+    ("click124_A_180s.mp3", 124, "A", 180),
+]
+# Fuerza la ruta por bloques de extract_features (> STREAMING_MIN_SECONDS); sólo con --long
+LONG_CASES = [("click110_C_1200s.flac", 110, "C", 1200)]
+
+
+def _timed(fn, repeat, memory=True):
+    """(mejor tiempo, memoria pico en MB o None, resultado de la última ejecución)."""
+    best, result = None, None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return best, peak, result
+
+
+def _bpm_ok(found, truth):
+    # Se aceptan errores de octava (mitad/doble), habituales en beat tracking
+    return any(abs(found - truth * k) <= max(2.0, 0.02 * truth) for k in (0.5, 1.0, 2.0))
+
+
+def _stages(audio_dir, cases):
+    """Genera (nombre, función, segundos_de_audio, bytes, verdad) por etapa."""
+    from services.audio_service import analyze_track, mix_tracks_local, smart_dj_mix
+    from services.feature_service import ANALYSIS_PROFILES, extract_features
+    from services.file_utils import sha256_fileobj
+    from services import ffmpeg_runner
+
+    paths = {name: synth.write(os.path.join(audio_dir, name), bpm, key, secs) for name, bpm, key, secs in cases}
+
+    for name, bpm, key, secs in cases:
+        path = paths[name]
+        size = os.path.getsize(path)
+
+        def _hash(path=path):
+            with open(path, "rb") as f:
+                return sha256_fileobj(f)
+        yield f"hash:{name}", _hash, None, size, None
+
+        for profile in ANALYSIS_PROFILES:
+            yield (f"features:{profile}:{name}", lambda path=path, p=profile: extract_features(path, p),
+                   secs, None, (bpm, key))
+        yield f"analyze_track:{name}", lambda path=path: analyze_track(path), secs, None, (bpm, key)
+
+    if not ffmpeg_runner.available():
+        print("FFmpeg no disponible: se omiten las etapas de mezcla.", file=sys.stderr)
+        return
+    short = [name for name, _, _, secs in cases if secs <= 30]
+    yield ("mix_local:2x30s", lambda: mix_tracks_local(short[:2], audio_dir, "out/bench_local.mp3"),
+           30, None, None)
+    yield ("smart_dj_mix:2x30s", lambda: smart_dj_mix(short[:2], audio_dir, out_name="out/bench_smart.mp3"),
+           60, None, None)
+
+
+def run(args):
+    cases = CASES + (LONG_CASES if args.long else [])
+    audio_dir = args.audio_dir or os.path.join(tempfile.gettempdir(), "harmonymix-bench")
+    os.makedirs(audio_dir, exist_ok=True)
+
+    # Calentamiento: la primera llamada a librosa compila con numba y no es representativa
+    from services.feature_service import extract_features
+    extract_features(synth.write(os.path.join(audio_dir, "warmup_5s.wav"), 120, "C", 5), "fast")
+
+    results = {}
+    for name, fn, audio_secs, size, truth in _stages(audio_dir, cases):
+        if args.only and args.only not in name:
+            continue
+        repeat = 1 if audio_secs and audio_secs > 300 else args.repeat
+        secs, peak, out = _timed(fn, repeat, memory=not args.no_memory and not name.startswith(("mix", "smart")))
+        row = {"seconds": round(secs, 4)}
+        if peak is not None:
+            row["peak_mb"] = round(peak, 1)
+        if audio_secs:
+            row["x_realtime"] = round(audio_secs / secs, 1)
+        if size:
+            row["mb_per_s"] = round(size / 2 ** 20 / secs, 1)
+        if truth and isinstance(out, dict):
+            row["bpm"] = round(float(out["bpm"]), 2)
+            row["key"] = out["musicalKey"]
+            row["bpm_ok"] = _bpm_ok(row["bpm"], truth[0])
+            row["key_ok"] = row["key"] == truth[1]
+        results[name] = row
+        print(f"{name:<44} " + "  ".join(f"{k}={v}" for k, v in row.items()), flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Lista de regresiones (texto) frente a la línea base."""
+    problems = []
+    for name, row in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if row["seconds"] > base["seconds"] * (1 + tolerance) and row["seconds"] - base["seconds"] > MIN_DELTA_SEC:
+            problems.append(f"{name}: {row['seconds']:.3f}s vs {base['seconds']:.3f}s (+{row['seconds'] / base['seconds'] - 1:.0%})")
+        if "bpm" in base and abs(row.get("bpm", -1) - base["bpm"]) > BPM_TOLERANCE:
+            problems.append(f"{name}: BPM {row.get('bpm')} vs {base['bpm']}")
+        if "key" in base and row.get("key") != base["key"]:
+            problems.append(f"{name}: key {row.get('key')} vs {base['key']}")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de HarmonyMix sobre audio sintético")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", help="sólo etapas cuyo nombre contenga este texto")
+    parser.add_argument("--long", action="store_true", help="incluye el caso de 20 min (ruta por bloques)")
+    parser.add_argument("--audio-dir", help="dónde generar/reutilizar el audio sintético")
+    parser.add_argument("--no-memory", action="store_true", help="no mide memoria pico (más rápido)")
+    parser.add_argument("--tolerance", type=float, default=TIME_TOLERANCE)
+    parser.add_argument("--check", action="store_true", help="código de salida 1 si hay regresiones")
+    parser.add_argument("--update", action="store_true", help="guarda los resultados como línea base")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+
+    if args.update:
+        baseline = {}
+        if os.path.exists(BASELINE):
+            with open(BASELINE) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True, ensure_ascii=False)
+            f.write("\n")
+        print(f"Línea base actualizada: {BASELINE}")
+        return 0
+
+    if not os.path.exists(BASELINE):
+        print("No hay línea base; ejecuta con --update para crearla.")
+        return 0
+    with open(BASELINE) as f:
+        problems = compare(results, json.load(f), args.tolerance)
+    wrong = [n for n, r in results.items() if r.get("bpm_ok") is False or r.get("key_ok") is False]
+    for p in problems:
+        print(f"REGRESIÓN {p}")
+    if wrong:
+        print(f"Análisis fuera de la verdad sintética (ya estaba así si no hay regresión): {', '.join(wrong)}")
+    if not problems:
+        print("Sin regresiones frente a la línea base.")
+    return 1 if problems and args.check else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
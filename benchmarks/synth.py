@@ -0,0 +1,61 @@
+# benchmarks/synth.py
+import os
+
+import numpy as np
+import soundfile as sf
+
+# Audio sintético determinista con tempo y tonalidad conocidos:
+#   - click de bombo en cada beat (acento en el primero de cada compás de 4)
+#   - acorde mayor sostenido con la tónica dominante (argmax del chroma = tonalidad)
+# La misma semilla y los mismos parámetros producen siempre los mismos bytes.
+SR = 44100
+KEYS = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+_SEED = 1234
+
+
+def _key_freq(key: str, octave: int = 3) -> float:
+    midi = 12 * (octave + 1) + KEYS.index(key)
+    return 440.0 * 2 ** ((midi - 69) / 12)
+
+
+def render(bpm: float, key: str, seconds: float, sr: int = SR) -> np.ndarray:
+    """Señal estéreo float32 (n, 2) en [-1, 1]."""
+    rng = np.random.default_rng(_SEED)
+    n = int(seconds * sr)
+    t = np.arange(n, dtype=np.float64) / sr
+
+    # Acorde: tónica fuerte + tercera mayor + quinta, con un armónico cada una
+    root = _key_freq(key)
+    tone = np.zeros(n)
+    for ratio, amp in ((1.0, 0.30), (2 ** (4 / 12), 0.12), (2 ** (7 / 12), 0.12)):
+        f = root * ratio
+        tone += amp * np.sin(2 * np.pi * f * t) + 0.3 * amp * np.sin(2 * np.pi * 2 * f * t)
+
+    # Clicks: 60 Hz con caída exponencial + un poco de ruido para el ataque
+    click_len = int(0.08 * sr)
+    env = np.exp(-np.arange(click_len) / (0.015 * sr))
+    click = (np.sin(2 * np.pi * 60 * np.arange(click_len) / sr) + 0.3 * rng.standard_normal(click_len)) * env
+    clicks = np.zeros(n)
+    period = 60.0 / bpm
+    for i, start in enumerate(np.arange(0.0, seconds, period)):
+        s = int(start * sr)
+        e = min(n, s + click_len)
+        clicks[s:e] += (1.0 if i % 4 == 0 else 0.6) * click[: e - s]
+
+    mono = 0.5 * tone + 0.5 * clicks
+    mono /= max(1e-9, np.max(np.abs(mono))) / 0.9
+    return np.stack([mono, mono], axis=1).astype(np.float32)
+
+
+def write(path: str, bpm: float, key: str, seconds: float, sr: int = SR) -> str:
+    """Escribe el caso en path; el formato sale de la extensión (.wav, .flac, .ogg, .mp3)."""
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    ext = os.path.splitext(path)[1].lower()
+    fmt = {".wav": "WAV", ".flac": "FLAC", ".ogg": "OGG", ".mp3": "MP3"}[ext]
+    subtype = {"WAV": "PCM_16", "FLAC": "PCM_16", "OGG": "VORBIS", "MP3": "MPEG_LAYER_III"}[fmt]
+    tmp = path + ".part"
+    sf.write(tmp, render(bpm, key, seconds, sr), sr, format=fmt, subtype=subtype)
+    os.replace(tmp, path)
+    return path
@@ -1,5 +1,8 @@
+import logging
 import os
+import re
 from datetime import datetime
+from importlib.util import find_spec
 from flask import (
     Blueprint,
     request,
@@ -13,26 +16,35 @@ from flask import (
     flash
 )
 from bson import ObjectId
-from pymongo import MongoClient
-from werkzeug.utils import secure_filename
+from mongo import get_db
+from services import metrics
+
+AUDIO_DEPENDENCIES = ("librosa", "numpy", "soundfile")
 
 try:
-    from services.audio_service import enviar_a_audiostack, smart_dj_mix
-    from services.file_utils import sha256_fileobj, save_unique
-    from services.feature_service import extract_features, calc_duration_seconds
-    SERVICES_AVAILABLE = True
+    from services.audio_service import enviar_a_audiostack, smart_dj_mix, analyze_track, render_params
+    from services.file_utils import save_unique_hashed
+    from services.feature_service import calc_duration_seconds, analyze_many
+    from services import job_service, mix_cache, analysis_queue, similarity_service, waveform_service, export_service, blob_store, ffmpeg_runner
+    # Los servicios cargan librosa/NumPy/soundfile en el primer uso: aquí sólo se comprueba que estén instalados
+    SERVICES_AVAILABLE = all(find_spec(m) is not None for m in AUDIO_DEPENDENCIES)
 except ImportError:
     SERVICES_AVAILABLE = False
-    def smart_dj_mix(names, out_dir):
+    def smart_dj_mix(names, out_dir, features=None, out_name=None):
         raise NotImplementedError("El servicio 'smart_dj_mix' no está disponible.")
-    def enviar_a_audiostack(paths, out_dir):
+    def enviar_a_audiostack(paths, out_dir, out_name=None):
         raise NotImplementedError("El servicio 'enviar_a_audiostack' no está disponible.")
 
 # --- Configuración del Blueprint ---
 mezcla_bp = Blueprint('mezcla', __name__)
+log = logging.getLogger(__name__)
 
 ALLOWED_EXTS = {'.mp3', '.wav', '.m4a', '.flac', '.aac', '.ogg'}
+# Subidas que responden sin esperar a librosa (el análisis queda en segundo plano)
+UPLOAD_DEFER_ANALYSIS = (os.getenv("UPLOAD_DEFER_ANALYSIS") or "0").strip() == "1"
 MIX_NAME = 'mix_ia_final.mp3'
+JOBS_DIR = 'jobs'
+_SHA256_RE = re.compile(r"[0-9a-f]{64}")
 
 # --- Funciones Auxiliares ---
 def _uploads_dir():
@@ -41,26 +53,95 @@ def _uploads_dir():
     return uploads
 
 def _get_db_connection():
-    """Centraliza la conexión a la base de datos usando las variables de entorno."""
+    """Base de datos sobre el cliente compartido del proceso (mongo.get_db), sin abrir conexiones nuevas."""
     MONGO_URL = os.getenv("MONGO_URL") 
     MONGO_DB_NAME = os.getenv("MONGO_DB") 
     if not MONGO_URL or not MONGO_DB_NAME:
         raise ValueError("Variables de entorno MONGO_URL o MONGO_DB no encontradas.")
-    client = MongoClient(MONGO_URL)
-    return client[MONGO_DB_NAME]
-
-def _ensure_final_name(uploads_dir: str, produced_name_or_path: str) -> str:
-    """Asegura que el archivo de mezcla final se llame MIX_NAME."""
-    final_path = os.path.join(uploads_dir, MIX_NAME)
-    if os.path.exists(final_path):
-        return MIX_NAME
-    candidate = produced_name_or_path or ""
-    if not os.path.isabs(candidate):
-        candidate = os.path.join(uploads_dir, os.path.basename(candidate))
-    if os.path.exists(candidate):
-        os.replace(candidate, final_path)
-        return MIX_NAME
-    raise FileNotFoundError(f"No se encontró la mezcla generada '{produced_name_or_path}' para normalizarla.")
+    return get_db()
+
+def mix_actual(uploads_dir: str):
+    """Mezcla más reciente de la sesión (salida de su último trabajo) o, si no, MIX_NAME."""
+    for name in (session.get("mix_actual"), MIX_NAME):
+        if name and os.path.exists(os.path.join(uploads_dir, name)):
+            return name
+    return None
+
+def _borrar_salida_job(uploads_dir: str, job: dict):
+    """Limpieza al caducar un trabajo: borra su archivo propio en JOBS_DIR."""
+    archivo = job.get("archivo") or ""
+    if archivo.startswith(JOBS_DIR + "/"):
+        path = os.path.join(uploads_dir, archivo)
+        if os.path.exists(path):
+            os.remove(path)
+        waveform_service.remove_peaks(path)
+
+if SERVICES_AVAILABLE:
+    # La purga de trabajos caducados corre dentro de una petición (submit/get): current_app está disponible
+    job_service.on_expire(lambda job: _borrar_salida_job(_uploads_dir(), job))
+
+def _features_for_mix(db, user_id, uploads_dir, names, stored_only=False):
+    """
+    Devuelve {nombre: features} para el modo smart.
+    Busca primero en trackFeatures (por pista y, si no, por sha256 del contenido);
+    sólo analiza con librosa lo que falte y guarda el resultado para la próxima vez.
+    stored_only: sólo lo ya guardado, sin analizar nada (puede faltar alguna pista).
+    """
+    tracks = list(db.tracks.find(
+        {"userId": user_id, "storedName": {"$in": names}},
+        {"storedName": 1, "sha256": 1, "analysisStatus": 1},
+    ))
+    by_name = {t["storedName"]: t for t in tracks}
+
+    # 1) Features de las propias pistas
+    feats_by_track = {
+        f["trackId"]: f
+        for f in db.trackFeatures.find({"trackId": {"$in": [t["_id"] for t in tracks]}})
+    }
+    result = {}
+    for name in names:
+        t = by_name.get(name)
+        if t and t["_id"] in feats_by_track:
+            result[name] = feats_by_track[t["_id"]]
+            if not stored_only and not analysis_queue.complete(result[name]):
+                # Documento parcial de versiones anteriores: basta para mezclar, se completa en segundo plano
+                analysis_queue.schedule(db, t["_id"], os.path.join(uploads_dir, name))
+
+    # 2) Mismo contenido subido en otra pista (misma sha256)
+    hashes = {by_name[n]["sha256"]: n for n in names
+              if n not in result and n in by_name and by_name[n].get("sha256")}
+    if hashes:
+        twins = {t["_id"]: t["sha256"] for t in db.tracks.find({"sha256": {"$in": list(hashes)}}, {"sha256": 1})}
+        for f in db.trackFeatures.find({"trackId": {"$in": list(twins)}}):
+            name = hashes.get(twins[f["trackId"]])
+            if name and name not in result:
+                result[name] = f
+    if stored_only:
+        return result
+
+    # 3) Cache miss: las pistas del usuario pasan por la cola de análisis (análisis completo,
+    #    persistido y con su estado); sólo lo que no es una pista guardada se analiza aquí sin guardar
+    for name in names:
+        if name in result:
+            continue
+        path = os.path.join(uploads_dir, name)
+        t = by_name.get(name)
+        if t:
+            result[name] = analysis_queue.ensure_features(db, t["_id"], path)
+        else:
+            result[name] = analyze_track(path)
+    return result
+
+
+def _content_hashes(db, user_id, uploads_dir, names):
+    """sha256 de cada pista: el guardado en 'tracks' o, si no existe, el del archivo (memorizado)."""
+    stored = {}
+    for t in db.tracks.find(
+        {"userId": user_id, "storedName": {"$in": names}, "sha256": {"$exists": True}},
+        {"storedName": 1, "sha256": 1},
+    ):
+        stored[t["storedName"]] = t["sha256"]
+    return [stored.get(n) or mix_cache.file_sha256(os.path.join(uploads_dir, n)) for n in names]
 
 
 # --- Rutas del Blueprint ---
@@ -76,16 +157,60 @@ def vista_mezcla():
     # 1. Conectarse a la base de datos(Atlas).
     db = _get_db_connection()
     # 2. Buscar en la colección 'tracks' solo los documentos del usuario actual.
-    user_tracks = list(db.tracks.find({"user_id": user_id_obj}).sort("created_at", -1))
+    user_tracks = list(db.tracks.find({"userId": user_id_obj}).sort("uploadedAt", -1))
 
     uploads_dir = _uploads_dir()
-    audio_file = MIX_NAME if os.path.exists(os.path.join(uploads_dir, MIX_NAME)) else None
+    audio_file = mix_actual(uploads_dir)
     return render_template('mezcla.html', pistas_usuario=user_tracks, audio_file=audio_file)
 
 
+def _mix_cache_key(hashes, params, features=None):
+    """Clave de caché de la mezcla; en modo smart incluye el análisis usado de cada pista."""
+    if features is not None:
+        params = {**params, "features": mix_cache.features_digest(features)}
+    return mix_cache.cache_key(hashes, params["engine"], params)
+
+
+def _run_mix(job_id, user_id, uploads_dir, safe_names, file_paths, mode, cache=None):
+    """
+    Trabajo en segundo plano: genera la mezcla en jobs/<job_id>.mp3 (y la pasa a la caché).
+    cache: (hashes, render_params) con los que se calcula la clave, o None para no cachear.
+    Sólo se cachea si el motor que produjo la mezcla es el de render_params.
+    """
+    out_name = f"{JOBS_DIR}/{job_id}.mp3"
+    cache_key = None
+    # Progreso y cancelación del trabajo llegan a cada ejecución de FFmpeg de este hilo
+    with metrics.trace_context(f"job:{job_id}"), \
+            ffmpeg_runner.job_context(on_progress=lambda p: job_service.progress(job_id, p),
+                                      cancel_event=job_service.cancel_event(job_id)):
+        if mode == 'smart':
+            db = _get_db_connection()
+            with metrics.span("mix.features"):
+                feats = _features_for_mix(db, user_id, uploads_dir, safe_names)
+            with metrics.span("mix.render", mode="smart"):
+                produced = smart_dj_mix(safe_names, uploads_dir, features=feats, out_name=out_name)
+            if cache:
+                cache_key = _mix_cache_key(*cache, features=[feats[n] for n in safe_names])
+        else:
+            info = {}
+            with metrics.span("mix.render", mode="remote"):
+                produced = enviar_a_audiostack(file_paths, uploads_dir, out_name=out_name, render_info=info)
+            if cache and info.get("engine") == cache[1]["engine"]:
+                cache_key = _mix_cache_key(*cache)
+        if cache_key:
+            with metrics.span("mix.cache_store"):
+                produced = mix_cache.store(uploads_dir, cache_key, produced)
+        try:
+            with metrics.span("mix.peaks"):
+                waveform_service.generate_peaks(os.path.join(uploads_dir, produced))
+        except Exception as e:
+            log.warning("No se pudieron generar los picos de la mezcla: %s", e)
+    return produced
+
+
 @mezcla_bp.route('/mezclar', methods=['POST'])
 def mezclar():
-    """Recibe nombres de archivo y llama al servicio de IA para mezclarlos."""
+    """Encola la mezcla y devuelve de inmediato el id del trabajo para consultar su estado."""
     if "user_id" not in session:
         return jsonify({"ok": False, "mensaje": "Sesión expirada."}), 401
         
@@ -106,16 +231,80 @@ def mezclar():
     if any(not os.path.exists(p) for p in file_paths):
         return jsonify({"ok": False, "mensaje": "Uno de los archivos no fue encontrado."}), 404
 
+    user_id = ObjectId(session["user_id"])
+
+    # Caché de renders: mismas pistas + modo + parámetros (+ análisis en smart) -> se sirve sin volver a mezclar
+    cache, key = None, None
+    if mix_cache.enabled():
+        try:
+            db = _get_db_connection()
+            hashes = _content_hashes(db, user_id, uploads_dir, safe_names)
+            params = render_params(mode, len(safe_names))
+            cache = (hashes, params)
+            if params["engine"] == "smart":
+                # Sin el análisis guardado de todas las pistas no hay clave que buscar (se calcula en el trabajo)
+                stored = _features_for_mix(db, user_id, uploads_dir, safe_names, stored_only=True)
+                if all(n in stored for n in safe_names):
+                    key = _mix_cache_key(hashes, params, [stored[n] for n in safe_names])
+            else:
+                key = _mix_cache_key(hashes, params)
+        except Exception as e:
+            log.warning("Caché de mezclas no disponible: %s", e)
+        cached = mix_cache.lookup(uploads_dir, key) if key else None
+        metrics.event("mix_cache_hit" if cached else "mix_cache_miss")
+        if cached:
+            session["mix_actual"] = cached
+            return jsonify({"ok": True, "estado": job_service.LISTO, "archivo": cached,
+                            "mensaje": "Mezcla generada correctamente."})
+
     try:
-        if mode == 'smart' and len(safe_names) == 2:
-            produced = smart_dj_mix(safe_names, uploads_dir)
-        else:
-            produced = enviar_a_audiostack(file_paths, uploads_dir)
-        final_name = _ensure_final_name(uploads_dir, produced)
-        return jsonify({"ok": True, "archivo": final_name, "mensaje": "Mezcla generada correctamente."})
-    except Exception as e:
-        print(f"ERROR al mezclar: {e}")
-        return jsonify({"ok": False, "mensaje": f"Error al generar la mezcla: {e}"}), 500
+        job_id = job_service.submit(
+            lambda jid: _run_mix(jid, user_id, uploads_dir, safe_names, file_paths, mode, cache),
+            owner=session["user_id"],
+        )
+    except job_service.ColaLlena as e:
+        return jsonify({"ok": False, "mensaje": str(e)}), 503
+
+    return jsonify({
+        "ok": True, "job": job_id, "estado": job_service.PENDIENTE,
+        "estadoUrl": url_for('mezcla.estado_mezcla', job_id=job_id),
+        "mensaje": "Mezcla en cola.",
+    }), 202
+
+
+@mezcla_bp.route('/mezclar/<job_id>', methods=['DELETE'])
+def cancelar_mezcla(job_id):
+    """Cancela un trabajo de mezcla pendiente o en curso (detiene su FFmpeg)."""
+    if "user_id" not in session:
+        return jsonify({"ok": False, "mensaje": "Sesión expirada."}), 401
+    if not SERVICES_AVAILABLE:
+        return jsonify({"ok": False, "mensaje": "Los servicios de audio no están disponibles."}), 503
+
+    if not job_service.cancel(job_id, owner=session["user_id"]):
+        return jsonify({"ok": False, "mensaje": "Trabajo no encontrado o ya terminado."}), 404
+    return jsonify({"ok": True, "job": job_id, "mensaje": "Cancelando la mezcla..."}), 202
+
+@mezcla_bp.route('/mezclar/<job_id>', methods=['GET'])
+def estado_mezcla(job_id):
+    """Estado de un trabajo de mezcla: pendiente | procesando | listo | error | cancelado (+ progreso %)."""
+    if "user_id" not in session:
+        return jsonify({"ok": False, "mensaje": "Sesión expirada."}), 401
+    if not SERVICES_AVAILABLE:
+        return jsonify({"ok": False, "mensaje": "Los servicios de audio no están disponibles."}), 503
+
+    job = job_service.get(job_id, owner=session["user_id"])
+    if job is None:
+        return jsonify({"ok": False, "mensaje": "Trabajo no encontrado."}), 404
+
+    if job["estado"] == job_service.LISTO:
+        # La mezcla recién generada pasa a ser la "actual" del usuario (reproductor, exportar, guardar)
+        session["mix_actual"] = job["archivo"]
+        job["mensaje"] = "Mezcla generada correctamente."
+    elif job["estado"] == job_service.ERROR:
+        job["mensaje"] = f"Error al generar la mezcla: {job['mensaje']}"
+    elif job["estado"] == job_service.CANCELADO:
+        job["mensaje"] = "Mezcla cancelada."
+    return jsonify({"ok": job["estado"] != job_service.ERROR, "job": job_id, **{k: v for k, v in job.items() if k != "id"}})
 
 @mezcla_bp.route('/mezcla/upload', methods=['POST'])
 def upload_tracks():
@@ -138,35 +327,213 @@ def upload_tracks():
     db = _get_db_connection()
     
     guardados, rechazados, duplicados = [], [], []
+    pendientes, hashes_lote = [], set()
 
+    # 1) Guardado en disco calculando el hash en la misma pasada
+    escritos = []
     for f in files:
         if not f.filename or os.path.splitext(f.filename)[1].lower() not in ALLOWED_EXTS:
             rechazados.append({"name": f.filename, "reason": "extensión no permitida"})
             continue
         try:
-            file_hash = sha256_fileobj(f.stream)
-            if db.tracks.find_one({"sha256": file_hash, "userId": user_id}):
-                duplicados.append(f.filename)
+            stored_name, full_path, file_hash = save_unique_hashed(f, uploads_dir)
+            escritos.append((f.filename, stored_name, full_path, file_hash))
+        except Exception as e:
+            rechazados.append({"name": f.filename, "reason": str(e)})
+
+    # 2) Deduplicado del lote completo con una sola consulta indexada ($in)
+    existentes = set()
+    if escritos:
+        with metrics.span("upload.dedupe"):
+            existentes = {t["sha256"] for t in db.tracks.find(
+                {"userId": user_id, "sha256": {"$in": [e[3] for e in escritos]}}, {"sha256": 1})}
+    for original, stored_name, full_path, file_hash in escritos:
+        if file_hash in existentes or file_hash in hashes_lote:
+            duplicados.append(original)
+            metrics.event("upload_duplicate")
+            try:
+                os.remove(full_path)
+            except OSError:
+                pass
+            continue
+        hashes_lote.add(file_hash)
+        try:
+            # Mismo contenido ya subido (por otro usuario): la pista queda enlazada a ese blob
+            blob_store.adopt(uploads_dir, full_path, file_hash)
+        except OSError:
+            pass
+        pendientes.append((original, stored_name, full_path, file_hash))
+
+    diferido = UPLOAD_DEFER_ANALYSIS or request.form.get('diferido') in ('1', 'true')
+    if diferido:
+        # 3') Se guarda la pista ya; trackFeatures se completa en segundo plano
+        for original, stored_name, full_path, file_hash in pendientes:
+            try:
+                duration = calc_duration_seconds(full_path)
+                track_doc = {
+                    "userId": user_id, "originalName": original, "storedName": stored_name,
+                    "sha256": file_hash, "storage": {"provider": "local", "url": None},
+                    "durationSec": duration, "uploadedAt": datetime.utcnow(),
+                    "analysisStatus": analysis_queue.PENDIENTE,
+                }
+                ins = db.tracks.insert_one(track_doc)
+            except Exception as e:
+                rechazados.append({"name": original, "reason": str(e)})
                 continue
-            
-            stored_name, full_path = save_unique(f, uploads_dir)
-            duration = calc_duration_seconds(full_path)
-            feats = extract_features(full_path)
+            # La pista ya está guardada: si no se puede encolar, queda en error y /analisis la reintenta
+            estado = analysis_queue.PENDIENTE
+            try:
+                analysis_queue.schedule(db, ins.inserted_id, full_path)
+            except Exception as e:
+                log.warning("No se pudo encolar el análisis de %s: %s", stored_name, e)
+                estado = analysis_queue.ERROR
+                db.tracks.update_one({"_id": ins.inserted_id},
+                                     {"$set": {"analysisStatus": estado, "analysisError": str(e)}})
+            try:
+                waveform_service.generate_peaks_async(full_path)
+            except Exception as e:
+                # Los picos se generan igualmente en la primera petición a /mezcla/peaks
+                log.warning("No se pudieron encolar los picos de %s: %s", stored_name, e)
+            guardados.append({"trackId": str(ins.inserted_id), "originalName": original, "storedName": stored_name,
+                              "durationSec": duration, "analysisStatus": estado})
+        return jsonify({"ok": True, "guardados": guardados, "duplicados": duplicados, "rechazados": rechazados}), 202
 
+    # 3) Análisis (librosa) en paralelo, un proceso por núcleo
+    with metrics.span("upload.analyze"):
+        resultados = analyze_many([full_path for _, _, full_path, _ in pendientes])
+
+    # 4) Persistencia, conservando el reporte por archivo
+    for (original, stored_name, full_path, file_hash), res in zip(pendientes, resultados):
+        try:
+            if isinstance(res, Exception):
+                raise res
+            duration, feats = res
             track_doc = {
-                "userId": user_id, "originalName": f.filename, "storedName": stored_name,
+                "userId": user_id, "originalName": original, "storedName": stored_name,
                 "sha256": file_hash, "storage": {"provider": "local", "url": None},
-                "durationSec": duration, "uploadedAt": datetime.utcnow()
+                "durationSec": duration, "uploadedAt": datetime.utcnow(),
+                "analysisStatus": analysis_queue.LISTO,
             }
-            ins = db.tracks.insert_one(track_doc)
-            db.trackFeatures.insert_one({"trackId": ins.inserted_id, **feats, "createdAt": datetime.utcnow()})
-            guardados.append({"originalName": f.filename, "storedName": stored_name, "durationSec": duration, **feats})
+            with metrics.span("upload.persist"):
+                ins = db.tracks.insert_one(track_doc)
+                db.trackFeatures.insert_one({"trackId": ins.inserted_id, **feats, "createdAt": datetime.utcnow()})
+                similarity_service.track_added(user_id, ins.inserted_id, stored_name, original, feats)
+            guardados.append({"trackId": str(ins.inserted_id), "originalName": original, "storedName": stored_name,
+                              "durationSec": duration, "analysisStatus": analysis_queue.LISTO, **feats})
         except Exception as e:
-            rechazados.append({"name": f.filename, "reason": str(e)})
+            rechazados.append({"name": original, "reason": str(e)})
 
     return jsonify({"ok": True, "guardados": guardados, "duplicados": duplicados, "rechazados": rechazados})
 
 
+@mezcla_bp.route('/mezcla/tracks/<track_id>/analisis', methods=['GET', 'POST'])
+def analisis_track(track_id):
+    """
+    Estado del análisis de una pista (pendiente | listo | error).
+    POST (o ?esperar=1) lanza el análisis si hace falta y espera a que termine.
+    """
+    if 'user_id' not in session:
+        return jsonify({"ok": False, "mensaje": "Sesión no válida."}), 401
+    if not SERVICES_AVAILABLE:
+        return jsonify({"ok": False, "mensaje": "Los servicios de análisis de audio no están disponibles."}), 503
+
+    db = _get_db_connection()
+    try:
+        track = db.tracks.find_one({"_id": ObjectId(track_id), "userId": ObjectId(session['user_id'])})
+    except Exception:
+        track = None
+    if not track:
+        return jsonify({"ok": False, "mensaje": "Pista no encontrada."}), 404
+
+    esperar = request.method == 'POST' or request.args.get('esperar') == '1'
+    if esperar and track.get("analysisStatus") != analysis_queue.LISTO:
+        try:
+            analysis_queue.ensure_features(db, track["_id"], os.path.join(_uploads_dir(), track["storedName"]), timeout=300)
+        except Exception as e:
+            return jsonify({"ok": False, "estado": analysis_queue.ERROR, "mensaje": str(e)}), 500
+        track = db.tracks.find_one({"_id": track["_id"]})
+
+    feats = db.trackFeatures.find_one({"trackId": track["_id"]}, {"_id": 0, "trackId": 0, "createdAt": 0})
+    estado = analysis_queue.LISTO if analysis_queue.complete(feats) else (track.get("analysisStatus") or analysis_queue.PENDIENTE)
+    return jsonify({"ok": True, "estado": estado, "features": feats, "error": track.get("analysisError")})
+
+
+@mezcla_bp.route('/mezcla/similares/<track_id>', methods=['GET'])
+def similares(track_id):
+    """
+    Pistas de la biblioteca del usuario que mezclan bien con track_id (timbre/armonía).
+    Query: k (10), metrica (coseno | euclidea), bpm_tol (ΔBPM máximo, opcional).
+    """
+    if 'user_id' not in session:
+        return jsonify({"ok": False, "mensaje": "Sesión no válida."}), 401
+    if not SERVICES_AVAILABLE:
+        return jsonify({"ok": False, "mensaje": "Los servicios de análisis de audio no están disponibles."}), 503
+
+    try:
+        tid = ObjectId(track_id)
+        k = max(1, min(100, int(request.args.get('k', 10))))
+        bpm_tol = request.args.get('bpm_tol', type=float)
+    except Exception:
+        return jsonify({"ok": False, "mensaje": "Parámetros no válidos."}), 400
+    metric = "euclidean" if request.args.get('metrica') == 'euclidea' else "cosine"
+
+    db = _get_db_connection()
+    resultados = similarity_service.similar_tracks(db, ObjectId(session['user_id']), tid, k=k, metric=metric, bpm_tol=bpm_tol)
+    if resultados is None:
+        return jsonify({"ok": False, "mensaje": "Pista no encontrada o sin análisis."}), 404
+    for r in resultados:
+        r["trackId"] = str(r["trackId"])
+    return jsonify({"ok": True, "similares": resultados})
+
+
+@mezcla_bp.route('/mezcla/peaks/<path:name>', methods=['GET'])
+def peaks(name):
+    """
+    Picos min/max (int8 intercalados) de una pista o mezcla para dibujar su forma de onda.
+    ?nivel=0..3 (0 = más detalle). ETag = sha256 de la pista (o clave de caché de la mezcla).
+    """
+    if 'user_id' not in session:
+        return jsonify({"ok": False, "mensaje": "Sesión no válida."}), 401
+    if not SERVICES_AVAILABLE:
+        return jsonify({"ok": False, "mensaje": "Los servicios de audio no están disponibles."}), 503
+
+    uploads_dir = _uploads_dir()
+    name = os.path.normpath(name).replace(os.sep, '/')
+    path = os.path.join(uploads_dir, name)
+    if (name.startswith('..') or os.path.isabs(name) or name.endswith(waveform_service.PEAKS_EXT)
+            or not os.path.isfile(path)):
+        return jsonify({"ok": False, "mensaje": "Audio no encontrado."}), 404
+    level = request.args.get('nivel', 0, type=int)
+
+    # ETag fuerte sin leer el audio: sha256 guardado de la pista, o el nombre direccionado por contenido
+    content_id = None
+    if name.startswith(mix_cache.CACHE_DIR + '/'):
+        content_id = os.path.splitext(os.path.basename(name))[0]
+        if not _SHA256_RE.fullmatch(content_id):
+            content_id = None
+    else:
+        track = _get_db_connection().tracks.find_one(
+            {"userId": ObjectId(session['user_id']), "storedName": name, "sha256": {"$exists": True}}, {"sha256": 1})
+        if track:
+            content_id = track["sha256"]
+    # Sólo lo direccionado por contenido es inmutable; el resto (p.ej. mix_ia_final.mp3) se revalida
+    immutable = content_id is not None
+    if content_id is None:
+        st = os.stat(path)
+        content_id = f"{st.st_size:x}-{st.st_mtime_ns:x}"
+    etag = f"{content_id}-{level}"
+    if etag in request.if_none_match:
+        return current_app.response_class(status=304, headers={"ETag": f'"{etag}"'})
+
+    sr, spp, data = waveform_service.read_level(path, level)
+    resp = current_app.response_class(data, mimetype="application/octet-stream")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, max-age=31536000, immutable" if immutable else "private, no-cache"
+    resp.headers["X-Sample-Rate"] = str(sr)
+    resp.headers["X-Samples-Per-Peak"] = str(spp)
+    return resp
+
+
 # =========================
 # Capa de compatibilidad para que app.py pueda llamar a estas funciones
 # =========================
@@ -174,9 +541,31 @@ def index(*args, **kwargs):
     return vista_mezcla()
 
 def exportar(*args, **kwargs):
+    """
+    Descarga la mezcla actual en ?formato=mp3|aac|flac|wav (&calidad=...).
+    El transcode se hace una vez por mezcla y formato; la respuesta admite Range (seek, reanudar).
+    """
     uploads_dir = _uploads_dir()
-    mix_path = os.path.join(uploads_dir, MIX_NAME)
-    if not os.path.exists(mix_path):
+    name = mix_actual(uploads_dir)
+    if not name:
         flash("Aún no existe una mezcla para exportar. Genérala primero.", "warning")
         return redirect(url_for('mezcla.vista_mezcla'))
-    return send_file(mix_path, as_attachment=True, download_name=f"HarmonyMind_Mix_{datetime.now().strftime('%Y%m%d')}.mp3")
+    try:
+        fmt, quality = export_service.resolve(request.args.get("formato"), request.args.get("calidad"))
+        name = export_service.export(uploads_dir, name, fmt, quality)
+    except export_service.FormatoNoSoportado as e:
+        formatos = ", ".join(f"{f} ({'/'.join(spec['qualities'])})" for f, spec in export_service.FORMATS.items())
+        flash(f"{e}. Formatos disponibles: {formatos}.", "error")
+        return redirect(url_for('mezcla.vista_mezcla'))
+    except Exception as e:
+        flash(f"No se pudo exportar la mezcla: {e}", "error")
+        return redirect(url_for('mezcla.vista_mezcla'))
+    mix_path = os.path.join(uploads_dir, name)
+    return send_file(
+        mix_path,
+        mimetype=export_service.mimetype(fmt),
+        as_attachment=True,
+        download_name=f"HarmonyMind_Mix_{datetime.now().strftime('%Y%m%d')}{export_service.extension(fmt)}",
+        conditional=True,
+        etag=True,
+    )
@@ -1,102 +1,282 @@
+import csv
+import io
+import json
+import os
 import sqlite3
+import threading
 
-DB_PATH = "harmony.db"
+# Por defecto junto a este módulo (no en el directorio de trabajo: arrancar desde otro sitio
+# crearía una cartera vacía)
+DB_PATH = os.getenv("DB_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "harmony.db")
+# Espera máxima por el lock de escritura de otra conexión antes de fallar con "database is locked"
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS") or 5000)
+# Cada cuántos movimientos de un usuario se guarda una foto de su saldo (wallet_snapshot)
+WALLET_SNAPSHOT_EVERY = int(os.getenv("WALLET_SNAPSHOT_EVERY") or 256)
+# Filas por página al exportar el ledger (memoria acotada, sin cursores abiertos entre páginas)
+LEDGER_EXPORT_PAGE = 1000
 
-def get_db():
-    """Conexión con acceso por nombre de columna."""
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+# Una conexión por hilo, reutilizada entre llamadas (y recreada tras un fork, como en mongo.py).
+# sqlite3 cachea en cada conexión las sentencias ya preparadas: las consultas de abajo son
+# constantes para que cada una se compile una sola vez por conexión.
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = set()  # DB_PATH ya inicializados en este proceso
+
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None, cached_statements=128)
     conn.row_factory = sqlite3.Row
+    # WAL: las lecturas no bloquean a la escritura y cada commit es un append al log.
+    # synchronous=NORMAL es seguro con WAL (sólo se sincroniza en los checkpoints).
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    return conn
+
+
+def get_db():
+    """Conexión del hilo actual (con acceso por nombre de columna), creada la primera vez."""
+    pid = os.getpid()
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != pid or _local.path != DB_PATH:
+        conn = _connect()
+        _local.conn, _local.pid, _local.path = conn, pid, DB_PATH
+        if (pid, DB_PATH) not in _schema_ready:
+            with _schema_lock:
+                if (pid, DB_PATH) not in _schema_ready:
+                    _init_schema(conn)
+                    _schema_ready.add((pid, DB_PATH))
     return conn
 
+
+class _transaction:
+    """
+    BEGIN IMMEDIATE ... COMMIT (o ROLLBACK si hay excepción) sobre la conexión del hilo.
+    IMMEDIATE toma el lock de escritura al empezar: dos operaciones concurrentes no leen
+    el mismo saldo para luego chocar al escribir.
+    """
+
+    def __enter__(self):
+        self.conn = get_db()
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
 # =========================
 #  Costos: wallet + ledger
 # =========================
+def _init_schema(conn):
+    # Billetera de créditos
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS wallet(
+        user_id INTEGER PRIMARY KEY,
+        credits INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    # Historial de movimientos (ledger)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS credit_ledger(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        delta INTEGER NOT NULL,
+        reason TEXT NOT NULL,         -- 'purchase','demo_purchase','consume','refund','admin'
+        note TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # Historial por usuario (WHERE user_id = ? ORDER BY id DESC) sin recorrer el ledger entero
+    conn.execute("CREATE INDEX IF NOT EXISTS credit_ledger_user_id ON credit_ledger(user_id, id)")
+    # Fotos del saldo: saldo tras el movimiento ledger_id, para reconstruirlo sin sumar todo el historial
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS wallet_snapshot(
+        user_id INTEGER NOT NULL,
+        ledger_id INTEGER NOT NULL,
+        balance INTEGER NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, ledger_id)
+    ) WITHOUT ROWID
+    """)
+
+
 def init_cost_tables():
-    """Crea tablas de costos si no existen."""
-    with get_db() as conn:
-        c = conn.cursor()
-        # Billetera de créditos
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS wallet(
-            user_id INTEGER PRIMARY KEY,
-            credits INTEGER NOT NULL DEFAULT 0
-        )
-        """)
-        # Historial de movimientos (ledger)
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS credit_ledger(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            delta INTEGER NOT NULL,
-            reason TEXT NOT NULL,         -- 'purchase','demo_purchase','consume','refund','admin'
-            note TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-        conn.commit()
-
-def _wallet_log(user_id: int, delta: int, reason: str, note: str | None = None) -> None:
-    """Registra un movimiento en el ledger."""
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute(
-            "INSERT INTO credit_ledger(user_id, delta, reason, note) VALUES (?,?,?,?)",
-            (user_id, delta, reason, note)
-        )
-        conn.commit()
+    """Crea tablas de costos si no existen (también se hace solo al abrir la primera conexión)."""
+    _init_schema(get_db())
+
+
+_SQL_GET = "SELECT credits FROM wallet WHERE user_id=?"
+_SQL_ENSURE = "INSERT OR IGNORE INTO wallet(user_id, credits) VALUES(?, 0)"
+_SQL_SET = "UPDATE wallet SET credits=? WHERE user_id=?"
+_SQL_ADD = "UPDATE wallet SET credits = credits + ? WHERE user_id=?"
+_SQL_CONSUME = "UPDATE wallet SET credits = credits - 1 WHERE user_id = ? AND credits > 0"
+_SQL_LOG = "INSERT INTO credit_ledger(user_id, delta, reason, note) VALUES (?,?,?,?)"
+
+
+_SQL_LAST_SNAPSHOT = "SELECT ledger_id, balance FROM wallet_snapshot WHERE user_id=? AND ledger_id<=? ORDER BY ledger_id DESC LIMIT 1"
+_SQL_SINCE_SNAPSHOT = "SELECT COUNT(*) FROM (SELECT 1 FROM credit_ledger WHERE user_id=? AND id>? LIMIT ?)"
+_SQL_SNAPSHOT = "INSERT OR REPLACE INTO wallet_snapshot(user_id, ledger_id, balance) VALUES (?,?,?)"
+_MAX_ID = 2 ** 63 - 1
+
+
+def _wallet_log(conn, user_id: int, delta: int, reason: str, note: str | None = None) -> None:
+    """
+    Registra un movimiento en el ledger, dentro de la transacción de quien lo llama.
+    Cada WALLET_SNAPSHOT_EVERY movimientos del usuario guarda también una foto de su saldo
+    (el conteo está acotado por LIMIT: nunca recorre más de WALLET_SNAPSHOT_EVERY entradas del índice).
+    """
+    ledger_id = conn.execute(_SQL_LOG, (user_id, delta, reason, note)).lastrowid
+    snap = conn.execute(_SQL_LAST_SNAPSHOT, (user_id, _MAX_ID)).fetchone()
+    since = conn.execute(_SQL_SINCE_SNAPSHOT, (user_id, snap["ledger_id"] if snap else 0, WALLET_SNAPSHOT_EVERY)).fetchone()[0]
+    if since >= WALLET_SNAPSHOT_EVERY:
+        balance = conn.execute(_SQL_GET, (user_id,)).fetchone()["credits"]
+        conn.execute(_SQL_SNAPSHOT, (user_id, ledger_id, balance))
+
 
 def wallet_get_credits(user_id: int) -> int:
-    """Obtiene créditos del usuario. Si no existe, lo crea con 0."""
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("SELECT credits FROM wallet WHERE user_id=?", (user_id,))
-        row = c.fetchone()
-        if not row:
-            c.execute("INSERT INTO wallet(user_id, credits) VALUES(?, 0)", (user_id,))
-            conn.commit()
-            return 0
-        return row["credits"]
-
-def wallet_add_credits(user_id: int, qty: int, reason: str = "admin", note: str | None = None) -> None:
+    """Obtiene créditos del usuario (0 si todavía no tiene billetera)."""
+    row = get_db().execute(_SQL_GET, (user_id,)).fetchone()
+    return int(row["credits"]) if row else 0
+
+
+def wallet_add_credits(user_id: int, qty: int, reason: str = "admin", note: str | None = None) -> int:
     """
-    Suma o resta créditos y registra en el ledger.
-    Usa qty negativo para restar (p.ej. ajustes/admin).
+    Suma o resta créditos y registra el movimiento en el ledger, en una sola transacción.
+    Usa qty negativo para restar (p.ej. ajustes/admin); el saldo no baja de 0 y el ledger
+    guarda el cambio realmente aplicado. Devuelve el saldo nuevo.
     """
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("INSERT OR IGNORE INTO wallet(user_id, credits) VALUES(?, 0)", (user_id,))
-        c.execute("UPDATE wallet SET credits = credits + ? WHERE user_id=?", (qty, user_id))
-        conn.commit()
-    _wallet_log(user_id, qty, reason, note)
+    with _transaction() as conn:
+        conn.execute(_SQL_ENSURE, (user_id,))
+        current = int(conn.execute(_SQL_GET, (user_id,)).fetchone()["credits"])
+        newval = max(0, current + int(qty))
+        if newval != current:
+            conn.execute(_SQL_SET, (newval, user_id))
+            _wallet_log(conn, user_id, newval - current, reason, note)
+    return newval
+
+
+def wallet_grant_many(grants, reason: str = "admin", note: str | None = None) -> int:
+    """
+    Abono masivo: grants es un iterable de (user_id, qty) con qty >= 0.
+    Todo (saldos y ledger) va en una única transacción y un único commit. Devuelve cuántos abonos aplicó.
+    No comprueba fotos de saldo por usuario: la siguiente operación individual las pone al día.
+    """
+    rows = [(int(uid), int(qty)) for uid, qty in grants if int(qty) != 0]
+    if any(qty < 0 for _, qty in rows):
+        raise ValueError("wallet_grant_many sólo admite cantidades positivas; usa wallet_add_credits para restar.")
+    if not rows:
+        return 0
+    with _transaction() as conn:
+        conn.executemany(_SQL_ENSURE, [(uid,) for uid, _ in rows])
+        conn.executemany(_SQL_ADD, [(qty, uid) for uid, qty in rows])
+        conn.executemany(_SQL_LOG, [(uid, qty, reason, note) for uid, qty in rows])
+    return len(rows)
+
 
 def wallet_consume_credit(user_id: int, reason: str = "consume", note: str | None = None) -> bool:
     """
-    Descuenta 1 crédito de forma ATÓMICA (no baja de 0).
+    Descuenta 1 crédito de forma ATÓMICA (no baja de 0), junto con su entrada en el ledger.
     Devuelve True si logró descontar, False si no tenía saldo.
     """
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("""
-            UPDATE wallet
-            SET credits = credits - 1
-            WHERE user_id = ? AND credits > 0
-        """, (user_id,))
-        conn.commit()
-        ok = (c.rowcount == 1)
-    if ok:
-        _wallet_log(user_id, -1, reason, note)
+    with _transaction() as conn:
+        ok = conn.execute(_SQL_CONSUME, (user_id,)).rowcount == 1
+        if ok:
+            _wallet_log(conn, user_id, -1, reason, note)
     return ok
 
-def wallet_get_history(user_id: int, limit: int = 100):
-    """Devuelve los últimos movimientos del ledger para el usuario."""
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("""
+
+def wallet_get_history(user_id: int, limit: int = 100, before_id: int | None = None):
+    """
+    Movimientos del ledger del usuario, del más reciente al más antiguo.
+    Paginación por cursor (keyset): before_id = id del último movimiento de la página anterior.
+    """
+    rows = get_db().execute("""
+        SELECT id, delta, reason, note, created_at
+        FROM credit_ledger
+        WHERE user_id = ? AND id < ?
+        ORDER BY id DESC
+        LIMIT ?
+    """, (user_id, before_id if before_id is not None else _MAX_ID, limit)).fetchall()
+    return [dict(r) for r in rows]
+
+
+def wallet_history_page(user_id: int, limit: int = 100, cursor: int | None = None):
+    """Una página del historial y el cursor de la siguiente (None si no hay más)."""
+    rows = wallet_get_history(user_id, limit + 1, cursor)
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1]["id"]
+    return rows, None
+
+
+def wallet_balance_at(user_id: int, ledger_id: int | None = None) -> int:
+    """
+    Saldo del usuario justo después del movimiento ledger_id (o tras el último, si es None):
+    última foto anterior + suma de los movimientos desde ella.
+    """
+    conn = get_db()
+    upto = ledger_id if ledger_id is not None else _MAX_ID
+    snap = conn.execute(_SQL_LAST_SNAPSHOT, (user_id, upto)).fetchone()
+    base, since = (snap["balance"], snap["ledger_id"]) if snap else (0, 0)
+    delta = conn.execute(
+        "SELECT COALESCE(SUM(delta), 0) FROM credit_ledger WHERE user_id = ? AND id > ? AND id <= ?",
+        (user_id, since, upto),
+    ).fetchone()[0]
+    return int(base + delta)
+
+
+def _iter_history(user_id: int):
+    """Todo el historial del usuario, página a página (del más antiguo al más reciente)."""
+    conn = get_db()
+    after = 0
+    while True:
+        rows = conn.execute("""
             SELECT id, delta, reason, note, created_at
             FROM credit_ledger
-            WHERE user_id = ?
-            ORDER BY id DESC
+            WHERE user_id = ? AND id > ?
+            ORDER BY id
             LIMIT ?
-        """, (user_id, limit))
-        rows = c.fetchall()
-        return [dict(r) for r in rows]
+        """, (user_id, after, LEDGER_EXPORT_PAGE)).fetchall()
+        if not rows:
+            return
+        yield from rows
+        after = rows[-1]["id"]
+
+
+_EXPORT_COLUMNS = ("id", "delta", "reason", "note", "created_at")
+
+
+def export_ledger_csv(user_id: int):
+    """Generador de líneas CSV del ledger del usuario (para Response(stream) o escribir a disco)."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(_EXPORT_COLUMNS)
+    for row in _iter_history(user_id):
+        writer.writerow([row[c] for c in _EXPORT_COLUMNS])
+        if buf.tell() >= 64 * 1024:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def export_ledger_json(user_id: int):
+    """Generador de un array JSON con el ledger del usuario, sin cargarlo entero en memoria."""
+    yield "["
+    first = True
+    for row in _iter_history(user_id):
+        yield ("" if first else ",") + json.dumps({c: row[c] for c in _EXPORT_COLUMNS}, ensure_ascii=False)
+        first = False
+    yield "]"
+
+
+if __name__ == "__main__":
+    # python db.py export <user_id> [csv|json] > ledger.csv
+    import sys
+
+    if len(sys.argv) < 3 or sys.argv[1] != "export":
+        sys.exit("uso: python db.py export <user_id> [csv|json]")
+    fmt = sys.argv[3] if len(sys.argv) > 3 else "csv"
+    for chunk in (export_ledger_json if fmt == "json" else export_ledger_csv)(int(sys.argv[2])):
+        sys.stdout.write(chunk)
@@ -1,16 +1,153 @@
 # mongo.py
 import os
-from pymongo import MongoClient, ASCENDING, DESCENDING
+import threading
+from pymongo import MongoClient, ASCENDING, DESCENDING, monitoring
 
-MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
-MONGO_DB  = os.getenv("MONGO_DB", "harmonymix")
+from services import metrics
 
-client = MongoClient(MONGO_URL)
-mdb = client[MONGO_DB]
+# Un único MongoClient por proceso (con su pool), compartido por app.py, el blueprint y este módulo.
+# Se crea perezosamente y se recrea tras un fork (p.ej. workers de Gunicorn con --preload).
+MONGO_MAX_POOL = int(os.getenv("MONGO_MAX_POOL") or 50)
+MONGO_MIN_POOL = int(os.getenv("MONGO_MIN_POOL") or 0)
+MONGO_TIMEOUT_MS = int(os.getenv("MONGO_TIMEOUT_MS") or 5000)
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS") or 30000)
 
-def ensure_indexes():
-    mdb.tracks.create_index([("userId", ASCENDING), ("uploadedAt", DESCENDING)])
-    mdb.tracks.create_index([("sha256", ASCENDING)], unique=True)
-    mdb.trackFeatures.create_index([("trackId", ASCENDING)], unique=True)
-    mdb.trackFeatures.create_index([("bpm", ASCENDING), ("musicalKey", ASCENDING)])
-    mdb.feedback.create_index([("userId", ASCENDING), ("target.type", ASCENDING), ("target.id", ASCENDING)])
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+
+
+class _CommandTimer(monitoring.CommandListener):
+    """Duración de cada comando (find, insert, update...) en harmonymix_mongo_seconds."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.observe("harmonymix_mongo_seconds", event.duration_micros / 1e6,
+                        command=event.command_name, outcome="ok")
+
+    def failed(self, event):
+        metrics.observe("harmonymix_mongo_seconds", event.duration_micros / 1e6,
+                        command=event.command_name, outcome="error")
+
+
+def get_client() -> MongoClient:
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                # El cliente heredado de otro proceso no se cierra aquí: sus sockets son del padre
+                _client = MongoClient(
+                    os.getenv("MONGO_URL", "mongodb://localhost:27017"),
+                    maxPoolSize=MONGO_MAX_POOL,
+                    minPoolSize=MONGO_MIN_POOL,
+                    serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+                    connectTimeoutMS=MONGO_TIMEOUT_MS,
+                    socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                    connect=False,
+                    event_listeners=[_CommandTimer()],
+                )
+                _client_pid = pid
+    return _client
+
+
+def get_db():
+    return get_client()[os.getenv("MONGO_DB", "harmonymix")]
+
+
+# Índices declarados: uno por forma de consulta real de la app.
+#   (colección, nombre, claves, opciones)  ->  quién la usa
+INDEXES = [
+    # /pistas, /mezcla: pistas del usuario ordenadas por fecha (esquema unificado, ver migrate_tracks_schema)
+    ("tracks", "userId_uploadedAt", [("userId", ASCENDING), ("uploadedAt", DESCENDING)], {}),
+    # /mezcla/upload: duplicados del lote ({userId, sha256: {$in}}); una pista por contenido y usuario
+    ("tracks", "userId_sha256", [("userId", ASCENDING), ("sha256", ASCENDING)],
+     {"unique": True, "partialFilterExpression": {"sha256": {"$exists": True}}}),
+    # /mezclar: pistas del usuario por nombre guardado (features y hashes de la mezcla)
+    ("tracks", "userId_storedName", [("userId", ASCENDING), ("storedName", ASCENDING)], {}),
+    # /mezclar: mismo contenido subido por otra pista (reutilizar trackFeatures)
+    ("tracks", "sha256", [("sha256", ASCENDING)], {}),
+    ("trackFeatures", "trackId", [("trackId", ASCENDING)], {"unique": True}),
+    ("trackFeatures", "bpm_musicalKey", [("bpm", ASCENDING), ("musicalKey", ASCENDING)], {}),
+    # /dashboard: últimas mezclas del usuario
+    ("mixes", "user_id_created_at", [("user_id", ASCENDING), ("created_at", DESCENDING)], {}),
+    # job_service: purga de trabajos de mezcla terminados y caducados
+    ("mixJobs", "estado_terminado", [("estado", ASCENDING), ("terminado", ASCENDING)], {}),
+    # /login, /register
+    ("users", "usuario", [("usuario", ASCENDING)], {}),
+    ("feedback", "userId_target", [("userId", ASCENDING), ("target.type", ASCENDING), ("target.id", ASCENDING)], {}),
+]
+
+_OPTION_KEYS = ("unique", "partialFilterExpression")
+
+
+def check_indexes(db=None):
+    """
+    Compara INDEXES con lo que hay en la base.
+    Devuelve una lista de (colección, nombre, problema) — vacía si todo está bien.
+    """
+    db = db if db is not None else get_db()
+    problems = []
+    for coll, name, keys, opts in INDEXES:
+        existing = {tuple(info["key"]): info for info in db[coll].index_information().values()}
+        info = existing.get(tuple(keys))
+        if info is None:
+            problems.append((coll, name, "falta"))
+            continue
+        for k in _OPTION_KEYS:
+            if info.get(k) != opts.get(k):
+                problems.append((coll, name, f"opción '{k}' distinta"))
+    return problems
+
+
+def ensure_indexes(db=None):
+    """
+    Crea los índices de INDEXES. Un índice con las mismas claves pero otras opciones
+    (p.ej. el antiguo sha256 único global) se elimina y se vuelve a crear.
+    """
+    db = db if db is not None else get_db()
+    for coll, name, keys, opts in INDEXES:
+        for old_name, info in db[coll].index_information().items():
+            if old_name == "_id_" or tuple(info["key"]) != tuple(keys):
+                continue
+            if old_name != name or any(info.get(k) != opts.get(k) for k in _OPTION_KEYS):
+                db[coll].drop_index(old_name)
+        db[coll].create_index(keys, name=name, **opts)
+    return check_indexes(db)
+
+
+def migrate_tracks_schema(db=None):
+    """
+    Unifica el esquema de 'tracks': los documentos de /upload (user_id, filename, created_at)
+    pasan a userId, storedName, uploadedAt como los de /mezcla/upload. Idempotente.
+    """
+    db = db if db is not None else get_db()
+    res = db.tracks.update_many(
+        {"user_id": {"$exists": True}},
+        {"$rename": {"user_id": "userId", "filename": "storedName", "created_at": "uploadedAt"}},
+    )
+    # originalName para los antiguos (el nombre subido coincide con el guardado)
+    db.tracks.update_many(
+        {"originalName": {"$exists": False}, "storedName": {"$exists": True}},
+        [{"$set": {"originalName": "$storedName"}}],
+    )
+    return res.modified_count
+
+
+if __name__ == "__main__":
+    # python mongo.py [migrate|indexes|check]
+    import sys
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "indexes"
+    if cmd == "migrate":
+        print(f"Pistas migradas al esquema unificado: {migrate_tracks_schema()}")
+        cmd = "indexes"
+    problems = ensure_indexes() if cmd == "indexes" else check_indexes()
+    for coll, name, problem in problems:
+        print(f"{coll}.{name}: {problem}")
+    print("Índices OK." if not problems else "Hay índices con problemas.")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,67 @@
+# services/analysis_queue.py
+import threading
+from datetime import datetime
+
+from services.feature_service import extract_features, submit
+from services import metrics, similarity_service
+
+# Estados de análisis guardados en tracks.analysisStatus
+PENDIENTE, LISTO, ERROR = "pendiente", "listo", "error"
+# Campos de un análisis completo (extract_features). Un trackFeatures sin ellos (p.ej. el que guardaba
+# la mezcla smart sólo con bpm/key/beatGrid) no vale para similitud y se vuelve a analizar.
+FULL_FIELDS = ("mfccMean", "chromaMean", "energy")
+
+_lock = threading.Lock()
+_futures = {}  # trackId -> Future del análisis en curso (en este proceso)
+
+
+def _persist(db, track_id, fut):
+    """Guarda el resultado en trackFeatures y marca el estado de la pista."""
+    with _lock:
+        _futures.pop(track_id, None)
+    try:
+        feats, samples = fut.result()
+        metrics.merge(samples)
+    except Exception as e:
+        db.tracks.update_one({"_id": track_id}, {"$set": {"analysisStatus": ERROR, "analysisError": str(e)}})
+        return
+    db.trackFeatures.update_one(
+        {"trackId": track_id},
+        {"$set": {**feats}, "$setOnInsert": {"trackId": track_id, "createdAt": datetime.utcnow()}},
+        upsert=True,
+    )
+    db.tracks.update_one({"_id": track_id}, {"$set": {"analysisStatus": LISTO}, "$unset": {"analysisError": ""}})
+    track = db.tracks.find_one({"_id": track_id}, {"userId": 1, "storedName": 1, "originalName": 1})
+    if track:
+        similarity_service.track_added(track["userId"], track_id, track.get("storedName"), track.get("originalName"), feats)
+
+
+def complete(doc) -> bool:
+    return bool(doc) and all(doc.get(k) is not None for k in FULL_FIELDS)
+
+
+def schedule(db, track_id, path):
+    """
+    Encola el análisis de una pista en el pool de procesos (si no está ya en curso).
+    Devuelve el Future; al terminar, el resultado se persiste solo.
+    """
+    with _lock:
+        fut = _futures.get(track_id)
+        if fut is not None:
+            return fut
+        fut = submit(metrics.collected, extract_features, path)
+        _futures[track_id] = fut
+    fut.add_done_callback(lambda f: _persist(db, track_id, f))
+    return fut
+
+
+def ensure_features(db, track_id, path, timeout=None):
+    """
+    Features de una pista, esperando si hace falta:
+    devuelve las de trackFeatures si ya están completas; si no, lanza (o se une a) su análisis y espera.
+    """
+    doc = db.trackFeatures.find_one({"trackId": track_id})
+    if complete(doc):
+        return doc
+    with metrics.span("analysis.wait_pending"):
+        return schedule(db, track_id, path).result(timeout=timeout)[0]
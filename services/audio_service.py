@@ -1,47 +1,48 @@
 # services/audio_service.py
+import logging
 import os
-import subprocess
-import requests
 from dotenv import load_dotenv
 
-# Opcionales para el modo "smart"
-import librosa
-import numpy as np
+from services import audiostack_client, ffmpeg_runner, metrics
+from services.feature_service import beat_grid, get_profile, load_for_analysis
 
 load_dotenv()
 
-AUDIOSTACK_API_KEY = (os.getenv("AUDIOSTACK_API_KEY") or "").strip().strip("'\"")
-AUDIOSTACK_ENDPOINT = (os.getenv("AUDIOSTACK_ENDPOINT") or "").strip().strip("'\"")
+log = logging.getLogger(__name__)
+
+AUDIOSTACK_API_KEY = audiostack_client.AUDIOSTACK_API_KEY
+AUDIOSTACK_ENDPOINT = audiostack_client.AUDIOSTACK_ENDPOINT
 MIX_NAME = "mix_ia_final.mp3"
+# Modo smart en una sola pasada de FFmpeg (sin WAV intermedios). "0" vuelve al modo de 3 pasadas.
+SMART_SINGLE_PASS = (os.getenv("SMART_SINGLE_PASS") or "1").strip() != "0"
+# Por debajo de esta confianza la rejilla de beats guardada no se usa para alinear transiciones
+BEAT_GRID_MIN_CONFIDENCE = 0.5
 
 
 # -------------------- Utilidades FFmpeg --------------------
+# Binario y filtros se sondean una vez por proceso (ffmpeg_runner), no en cada mezcla
 def _ffmpeg_exists():
-    try:
-        subprocess.run(["ffmpeg", "-version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-        return True
-    except Exception:
-        return False
+    return ffmpeg_runner.available()
 
 def _ffmpeg_has_filter(name: str) -> bool:
-    try:
-        out = subprocess.run(["ffmpeg", "-hide_banner", "-filters"],
-                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
-        return name in out.stdout
-    except Exception:
-        return False
+    return ffmpeg_runner.has_filter(name)
 
-def _endpoint_valido(url: str) -> bool:
-    if not url:
-        return False
-    u = url.lower()
-    return u.startswith("http") and "tu-endpoint" not in u and not u.startswith("<")
+def _out_path(uploads_dir, out_name):
+    """Ruta absoluta de salida; out_name puede incluir subcarpeta (p.ej. jobs/<id>.mp3)."""
+    path = os.path.join(uploads_dir, out_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+_endpoint_valido = audiostack_client.endpoint_valido
 
 
 # -------------------- Mezcla local simple (amix) --------------------
-def mix_tracks_local(file_names, uploads_dir):
+def _amix_filter(n):
+    return f"amix=inputs={n}:weights=1|1:duration=longest, dynaudnorm=f=75:g=15, alimiter=limit=0.95"
+
+def mix_tracks_local(file_names, uploads_dir, out_name=MIX_NAME):
     """
-    Mezcla N archivos usando FFmpeg (amix) y devuelve mix_ia_final.mp3
+    Mezcla N archivos usando FFmpeg (amix) y devuelve out_name (por defecto mix_ia_final.mp3)
     """
     if not file_names or len(file_names) < 2:
         raise ValueError("Selecciona al menos dos pistas para mezclar.")
@@ -57,77 +58,112 @@ def mix_tracks_local(file_names, uploads_dir):
         input_args += ["-i", path]
 
     n = len(file_names)
-    out_path = os.path.join(uploads_dir, MIX_NAME)
+    out_path = _out_path(uploads_dir, out_name)
 
-    # amix + normalización dinámica suave
-    cmd = [
-        "ffmpeg", *input_args, "-y",
-        "-filter_complex", f"amix=inputs={n}:weights=1|1:duration=longest, dynaudnorm=f=75:g=15, alimiter=limit=0.95",
+    # amix + normalización dinámica suave (duration=longest: dura lo que la pista más larga)
+    durations = [ffmpeg_runner.probe_duration(os.path.join(uploads_dir, name)) for name in file_names]
+    ffmpeg_runner.run([
+        *input_args, "-y",
+        "-filter_complex", _amix_filter(n),
         "-c:a", "libmp3lame", "-q:a", "2",
         out_path
-    ]
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if proc.returncode != 0:
-        raise RuntimeError(f"FFmpeg falló:\n{proc.stderr}")
+    ], duration=max((d for d in durations if d), default=None))
 
-    return MIX_NAME
+    return out_name
 
 
 # -------------------- Audiostack (fallback a local) --------------------
-def enviar_a_audiostack(file_paths, uploads_dir):
+def enviar_a_audiostack(file_paths, uploads_dir, out_name=MIX_NAME, render_info=None):
     """
     Envía N pistas a Audiostack si hay configuración válida; si no, mezcla local con FFmpeg.
+    También mezcla en local si el remoto falla tras sus reintentos o su circuito está abierto.
     file_paths: rutas absolutas a archivos en uploads_dir
+    render_info: dict opcional donde se anota el motor que produjo la mezcla ("audiostack" | "amix"),
+    que puede no ser el de render_params (p.ej. para no cachear un fallback como mezcla remota).
     """
+    info = render_info if render_info is not None else {}
+    file_names = [os.path.basename(p) for p in file_paths]
     # Fallback local si falta config o endpoint "placeholder"
-    if not AUDIOSTACK_API_KEY or not _endpoint_valido(AUDIOSTACK_ENDPOINT):
-        file_names = [os.path.basename(p) for p in file_paths]
-        return mix_tracks_local(file_names, uploads_dir)
-
-    headers = {"Authorization": f"Bearer {AUDIOSTACK_API_KEY}"}
+    if not audiostack_client.configured():
+        info["engine"] = "amix"
+        return mix_tracks_local(file_names, uploads_dir, out_name)
 
-    files = []
     try:
-        for p in file_paths:
-            f = open(p, "rb")
-            files.append(("files", (os.path.basename(p), f, "audio/mpeg")))
-        data = {"mode": "mixing", "output_format": "mp3"}
-        resp = requests.post(AUDIOSTACK_ENDPOINT, headers=headers, files=files, data=data, timeout=120)
-    finally:
-        for _, (name, fobj, _) in files:
-            try:
-                fobj.close()
-            except Exception:
-                pass
-
-    if resp.status_code == 200:
-        out_path = os.path.join(uploads_dir, MIX_NAME)
-        with open(out_path, "wb") as out_file:
-            out_file.write(resp.content)
-        return MIX_NAME
-    else:
+        audiostack_client.mix(file_paths, _out_path(uploads_dir, out_name))
+        info["engine"] = "audiostack"
+        return out_name
+    except audiostack_client.AudiostackError as remote_error:
         # Si falla, vuelve a la mezcla local
-        file_names = [os.path.basename(p) for p in file_paths]
+        log.warning("Audiostack no disponible, mezcla local: %s", remote_error)
+        info["engine"] = "amix"
         try:
-            return mix_tracks_local(file_names, uploads_dir)
+            return mix_tracks_local(file_names, uploads_dir, out_name)
         except Exception:
-            raise Exception(f"Error en Audiostack: {resp.status_code} - {resp.text}")
+            raise Exception(str(remote_error))
 
 
-# -------------------- Smart DJ Mix (2 pistas) --------------------
+# -------------------- Parámetros efectivos (clave de caché) --------------------
+def render_params(mode, n):
+    """
+    Parámetros que determinan el audio resultante para `mode` con n pistas.
+    Si cambia cualquiera de ellos (filtros, pasada única, endpoint remoto) cambia la clave de caché.
+    """
+    if mode == "smart":
+        return {
+            "engine": "smart",
+            "single_pass": SMART_SINGLE_PASS or n > 2,
+            "rubberband": _ffmpeg_has_filter("rubberband"),
+            "loudnorm": LOUDNORM,
+            "analysis_profile": SMART_ANALYSIS_PROFILE,
+            "beat_grid_min_confidence": BEAT_GRID_MIN_CONFIDENCE,
+        }
+    if AUDIOSTACK_API_KEY and _endpoint_valido(AUDIOSTACK_ENDPOINT):
+        return {"engine": "audiostack", "endpoint": AUDIOSTACK_ENDPOINT}
+    return {"engine": "amix", "filter": _amix_filter(n)}
+
+
+# -------------------- Smart DJ Mix (N pistas) --------------------
 KEYS = ["C","C#","D","D#","E","F","F#","G","G#","A","A#","B"]
 
-def _estimate_bpm(path):
-    y, sr = librosa.load(path, mono=True, duration=120)
-    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
-    return float(tempo) if tempo > 0 else 120.0
-
-def _estimate_key(path):
-    y, sr = librosa.load(path, mono=True, duration=90)
-    chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
+# Perfil para el análisis en vivo del modo smart (ver feature_service.ANALYSIS_PROFILES)
+SMART_ANALYSIS_PROFILE = (os.getenv("SMART_ANALYSIS_PROFILE") or "balanced").strip().lower()
+# La tonalidad se estima sobre, como mucho, los primeros 90 s del fragmento
+KEY_SECONDS = 90
+
+def _estimate_bpm(y, sr, hop_length=512, offset=0.0):
+    import librosa
+    import numpy as np
+    onset_env = librosa.onset.onset_strength(y=y, sr=sr, hop_length=hop_length)
+    tempo, beats = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr, hop_length=hop_length)
+    tempo = float(np.atleast_1d(tempo)[0])
+    return (tempo if tempo > 0 else 120.0), beat_grid(y, sr, beats, onset_env, hop_length=hop_length, offset=offset)
+
+def _estimate_key(y, sr, hop_length=512):
+    import librosa
+    import numpy as np
+    chroma = librosa.feature.chroma_cqt(y=y, sr=sr, hop_length=hop_length)
     chroma_mean = chroma.mean(axis=1)
     key_idx = int(np.argmax(chroma_mean))
-    return KEYS[key_idx]
+    return KEYS[key_idx], chroma_mean
+
+def analyze_track(path, profile=None):
+    """
+    Decodifica la pista UNA sola vez y calcula todo el análisis sobre ese buffer.
+    Devuelve un dict con las mismas claves que trackFeatures (bpm, musicalKey, chromaMean, beatGrid).
+    """
+    _, prof = get_profile(profile or SMART_ANALYSIS_PROFILE)
+    hop = prof["hop_length"]
+    y, sr, offset = load_for_analysis(path, prof)
+    with metrics.span("analysis.beats"):
+        bpm, grid = _estimate_bpm(y, sr, hop, offset)
+    with metrics.span("analysis.chroma_cqt"):
+        key, chroma_mean = _estimate_key(y[: int(KEY_SECONDS * sr)], sr, hop)
+    return {
+        "bpm": bpm,
+        "musicalKey": key,
+        "chromaMean": [float(x) for x in chroma_mean],
+        "beatGrid": grid,
+    }
 
 def _semitone_diff(k_from, k_to):
     i_from = KEYS.index(k_from)
@@ -146,109 +182,314 @@ def _rubberband_or_fallback_filter(tempo_ratio: float, semitones: int, use_rubbe
     new_rate = int(round(44100 * pitch_fac))
     return f"asetrate={new_rate},aresample=44100,atempo={tempo_ratio:.5f}"
 
+def _speed_factor(tempo_ratio: float, semitones: int, use_rubberband: bool) -> float:
+    """Cuántos segundos de entrada consume el filtro por cada segundo de salida."""
+    if use_rubberband:
+        return tempo_ratio
+    return max(0.5, min(2.0, tempo_ratio)) * 2 ** (semitones / 12.0)
 
+LOUDNORM = "loudnorm=I=-14:TP=-1.5:LRA=11"
 
-def smart_dj_mix(file_names, uploads_dir):
+def _leg_segments(leg, xfade, use_rb):
+    """
+    Tramos de una pista: [(inicio_en_origen, segundos_de_origen | None, segundos_de_salida | None, (tempo, semitonos))].
+    El fade-in y el fade-out llevan el ajuste de su transición; el cuerpo suena a su tempo y tono originales.
+    """
+    start, length, adj_in, adj_out = leg
+    segments, pos = [], start
+    if adj_in is not None:
+        src = xfade * _speed_factor(*adj_in, use_rb)
+        segments.append((pos, src, xfade, adj_in))
+        pos += src
+    if length is None:
+        segments.append((pos, None, None, (1.0, 0)))
+        return segments
+    body = length - xfade * ((adj_in is not None) + (adj_out is not None))
+    if body > 0:
+        segments.append((pos, body, body, (1.0, 0)))
+        pos += body
+    if adj_out is not None:
+        segments.append((pos, xfade * _speed_factor(*adj_out, use_rb), xfade, adj_out))
+    return segments
+
+def _chain_graph(legs, xfade, use_rb):
+    """
+    Grafo filter_complex de una pasada para N pistas.
+    legs: [(inicio_en_origen, segundos_de_salida | None, ajuste_entrada, ajuste_salida)] en orden de reproducción,
+    con cada ajuste (tempo, semitonos) o None en los extremos de la mezcla.
+      - Cada pista se recorta ANTES del time-stretch (sólo se procesa lo que suena)
+      - Sólo se estiran los tramos del crossfade; el cuerpo de la pista queda intacto
+      - Las pistas se encadenan con acrossfade y salen directas al encoder
+    """
+    fmt = "aresample=44100,aformat=sample_fmts=fltp:channel_layouts=stereo"
+    n = len(legs)
+    parts = []
+    for i, leg in enumerate(legs):
+        length = leg[1]
+        segments = _leg_segments(leg, xfade, use_rb)
+        labels = [f"[{i}:a]"]
+        if len(segments) > 1:
+            labels = [f"[a{i}_{k}]" for k in range(len(segments))]
+            parts.append(f"[{i}:a]asplit={len(segments)}{''.join(labels)}")
+        for k, (start, src, out, (tempo, semi)) in enumerate(segments):
+            chain = []
+            if src is not None:
+                # +1 s de margen: el tramo se corta después a su duración exacta de salida
+                chain += [f"atrim={start:.3f}:{start + src + 1.0:.3f}", "asetpts=PTS-STARTPTS"]
+            elif start > 0:
+                chain += [f"atrim=start={start:.3f}", "asetpts=PTS-STARTPTS"]
+            if abs(tempo - 1.0) > 1e-4 or semi:
+                chain.append(_rubberband_or_fallback_filter(tempo, semi, use_rb))
+            chain.append(fmt)
+            if out is not None:
+                chain.append(f"atrim=0:{out:.3f}")
+            parts.append(f"{labels[k]}{','.join(chain)}[s{i}_{k}]")
+        chain = [f"concat=n={len(segments)}:v=0:a=1"] if len(segments) > 1 else []
+        chain += [LOUDNORM, fmt]
+        if length is not None:
+            chain.append(f"atrim=0:{length:.3f}")
+        if i > 0:
+            chain.append(f"afade=t=in:st=0:d={xfade:.3f}")
+        if i < n - 1:
+            chain.append(f"afade=t=out:st={length - xfade:.3f}:d={xfade:.3f}")
+        inputs = "".join(f"[s{i}_{k}]" for k in range(len(segments)))
+        parts.append(f"{inputs}{','.join(chain)}[t{i}]")
+
+    prev = "t0"
+    for i in range(1, n):
+        tail = ",alimiter=limit=0.95" if i == n - 1 else f"[x{i}]"
+        parts.append(f"[{prev}][t{i}]acrossfade=d={xfade:.3f}:curve1=tri:curve2=tri{tail}")
+        prev = f"x{i}"
+    return ";".join(parts)
+
+def _expected_seconds(in_paths, legs, xfade):
+    """Duración aproximada de la mezcla (para el porcentaje de progreso); None si no se puede estimar."""
+    total = 0.0
+    for path, leg in zip(in_paths, legs):
+        length = leg[1]
+        if length is None:
+            src = ffmpeg_runner.probe_duration(path)
+            if src is None:
+                return None
+            *fixed, (start, _, _, _) = _leg_segments(leg, xfade, True)
+            length = sum(out for _, _, out, _ in fixed) + max(0.0, src - start)
+        total += length
+    return max(1.0, total - xfade * (len(legs) - 1))
+
+def _smart_single_pass(in_paths, out_path, legs, xfade, prefer_rb):
+    """Ejecuta el modo smart en un único proceso FFmpeg; reintenta sin rubberband si falla."""
+    input_args = []
+    for path in in_paths:
+        input_args += ["-i", path]
+    expected = _expected_seconds(in_paths, legs, xfade)
+    attempts = [True, False] if prefer_rb else [False]
+    for use_rb in attempts:
+        filter_complex = _chain_graph(legs, xfade, use_rb)
+        try:
+            ffmpeg_runner.run([
+                "-y", *input_args,
+                "-filter_complex", filter_complex,
+                "-c:a", "libmp3lame", "-q:a", "2",
+                out_path
+            ], duration=expected, what="FFmpeg smart mix")
+            return
+        except (ffmpeg_runner.FFmpegTimeout, ffmpeg_runner.FFmpegCancelled):
+            raise
+        except ffmpeg_runner.FFmpegError:
+            if not use_rb:
+                raise
+
+
+def _transition_cost(fa, fb):
+    """Coste de pasar de A a B: estiramiento de tempo (en semitonos equivalentes) + salto de tono."""
+    import numpy as np
+    bpm_a, bpm_b = max(fa["bpm"], 1.0), max(fb["bpm"], 1.0)
+    tempo_cost = abs(np.log2(bpm_b / bpm_a)) * 12
+    return tempo_cost + abs(_semitone_diff(fa["musicalKey"], fb["musicalKey"]))
+
+def order_tracks(file_names, features):
+    """
+    Ordena las pistas para minimizar estiramiento de tempo y cambio de tono entre vecinas.
+    Vecino más cercano desde cada pista inicial; se queda con el recorrido de menor coste.
+    """
+    n = len(file_names)
+    cost = [[_transition_cost(features[a], features[b]) for b in file_names] for a in file_names]
+    best, best_cost = list(range(n)), float("inf")
+    for start in range(n):
+        route, pending, total = [start], set(range(n)) - {start}, 0.0
+        while pending:
+            nxt = min(pending, key=lambda j: cost[route[-1]][j])
+            total += cost[route[-1]][nxt]
+            route.append(nxt)
+            pending.remove(nxt)
+        if total < best_cost:
+            best, best_cost = route, total
+    return [file_names[i] for i in best]
+
+
+def _grid_range(grid):
+    """
+    Tramo (s) de la pista que cubre la rejilla. Las rejillas antiguas no guardan rangeMs:
+    se da por cubierto desde los beats extremos (y desde 0 si el primer beat está en los 2 primeros segundos).
+    """
+    if grid.get("rangeMs"):
+        lo, hi = grid["rangeMs"]
+        return lo / 1000.0, hi / 1000.0
+    beats = grid["beatsMs"]
+    return (0.0 if beats[0] <= 2000 else beats[0] / 1000.0), beats[-1] / 1000.0
+
+def _downbeats(grid):
+    """Downbeats (s) de una beatGrid guardada, o None si no hay rejilla fiable."""
+    if not grid or grid.get("confidence", 0) < BEAT_GRID_MIN_CONFIDENCE:
+        return None
+    beats = grid.get("beatsMs") or []
+    if grid.get("firstDownbeatMs") not in beats:
+        return None
+    first = beats.index(grid["firstDownbeatMs"])
+    return [ms / 1000.0 for ms in beats[first::4]] or None
+
+def _align_legs(legs, grids, xfade):
     """
-    Mezcla inteligente para 2 pistas:
-      - Detecta BPM y Key con librosa
-      - Ajusta tempo/pitch (rubberband si está disponible; fallback si no)
+    Ajusta cada tramo a la rejilla de beats guardada:
+      - las pistas que entran (i > 0) empiezan en su primer downbeat
+      - el crossfade de salida arranca en el downbeat más cercano al punto previsto
+    Sólo donde la rejilla cubre ese punto: la de un perfil con fragmento central (p.ej. "fast")
+    no sirve para el inicio de la pista. Sin rejilla (o con poca confianza) el tramo queda como estaba.
+    """
+    aligned = []
+    for i, ((start, length, adj_in, adj_out), grid) in enumerate(zip(legs, grids)):
+        downbeats = _downbeats(grid)
+        if downbeats:
+            lo, hi = _grid_range(grid)
+            if i > 0 and lo <= start:
+                start = downbeats[0]
+            if length is not None:
+                # Inicio del crossfade de salida en segundos de origen, llevado al downbeat más cercano
+                segments = _leg_segments((start, length, adj_in, adj_out), xfade, True)
+                target = segments[-1][0]
+                body_start = segments[1][0] if adj_in is not None else start
+                if lo <= target <= hi:
+                    later = [d for d in downbeats if d > body_start]
+                    if later:
+                        snap = min(later, key=lambda d: abs(d - target))
+                        length = (snap - body_start) + xfade * ((adj_in is not None) + 1)
+        aligned.append((start, length, adj_in, adj_out))
+    return aligned
+
+
+def smart_dj_mix(file_names, uploads_dir, features=None, out_name=MIX_NAME):
+    """
+    Mezcla inteligente para 2 o más pistas:
+      - Usa BPM y Key de `features` ({nombre: trackFeatures}) o los detecta con librosa
+      - Con más de 2 pistas, las ordena por compatibilidad de BPM y tonalidad
+      - Ajusta tempo/pitch en cada crossfade hacia el punto medio de la transición
+        (rubberband si está disponible; fallback si no)
       - Normaliza loudness
-      - Hace crossfade por beats
-    Devuelve MIX_NAME (por defecto: mix_ia_final.mp3)
+      - Hace crossfade por beats entre cada par de pistas consecutivas, alineado a downbeats si hay beatGrid
+    Devuelve out_name (por defecto: mix_ia_final.mp3)
     """
-    if len(file_names) != 2:
-        # Por ahora el modo smart es para 2 pistas; más de 2 -> mezcla simple
-        return mix_tracks_local(file_names, uploads_dir)
-
-    a_in = os.path.join(uploads_dir, file_names[0])
-    b_in = os.path.join(uploads_dir, file_names[1])
+    import numpy as np
+    if len(file_names) < 2:
+        raise ValueError("Selecciona al menos dos pistas para mezclar.")
 
     if not _ffmpeg_exists():
         raise RuntimeError("FFmpeg no está instalado o no está en el PATH.")
 
-    # --- Análisis (BPM y Key) ---
-    bpm_a = _estimate_bpm(a_in)
-    bpm_b = _estimate_bpm(b_in)
-    key_a = _estimate_key(a_in)
-    key_b = _estimate_key(b_in)
-
-    # Objetivo: BPM promedio (limitado a 70–180)
-    target_bpm = max(70, min(180, round((bpm_a + bpm_b) / 2)))
-    tempo_a = target_bpm / bpm_a if bpm_a > 0 else 1.0
-    tempo_b = target_bpm / bpm_b if bpm_b > 0 else 1.0
-
-    # Ajuste de tono: llevamos B hacia A
-    semi_a = 0
-    semi_b = _semitone_diff(key_b, key_a)
+    # --- Análisis (BPM y Key): reutiliza trackFeatures; si falta, una decodificación por pista ---
+    features = dict(features or {})
+    for name in file_names:
+        if not features.get(name):
+            with metrics.span("mix.analyze_missing"):
+                features[name] = analyze_track(os.path.join(uploads_dir, name))
+
+    if len(file_names) > 2:
+        with metrics.span("mix.order"):
+            file_names = order_tracks(file_names, features)
+    in_paths = [os.path.join(uploads_dir, name) for name in file_names]
+    bpms = [features[name]["bpm"] for name in file_names]
+    keys = [features[name]["musicalKey"] for name in file_names]
+
+    # Cada transición se encuentra a medio camino: ambas pistas van a la media geométrica de sus BPM
+    # (limitada a 70–180) y la que entra toma la tonalidad de la que sale. Sólo se ajusta el cruce:
+    # cuanto mejor el orden, menos estiramiento.
+    bpms = [bpm if bpm > 0 else 120.0 for bpm in bpms]
+    meets = [max(70.0, min(180.0, float(np.sqrt(a * b)))) for a, b in zip(bpms, bpms[1:])]
+    adj_in = [None] + [(meet / bpm, _semitone_diff(k, k_prev))
+                       for meet, bpm, k, k_prev in zip(meets, bpms[1:], keys[1:], keys)]
+    adj_out = [(meet / bpm, 0) for meet, bpm in zip(meets, bpms)] + [None]
+    target_bpm = max(70, min(180, round(float(np.median(bpms)))))
 
     # Crossfade de 8 beats (clamp 4–16s) y una intro de A antes del cruce
     beat_sec = 60.0 / target_bpm
     xfade = max(4.0, min(16.0, 8 * beat_sec))
     intro_a = max(xfade + 2.0, 30.0)
+    # Las pistas intermedias necesitan sitio para el fade-in y el fade-out
+    middle = max(2 * xfade + 2.0, 30.0)
 
     # ¿Tenemos rubberband?
     prefer_rb = _ffmpeg_has_filter("rubberband")
 
-    # --- 1ª pasada: procesar cada pista a WAV temporal ---
-    a_proc = os.path.join(uploads_dir, "_a_proc.wav")
-    b_proc = os.path.join(uploads_dir, "_b_proc.wav")
+    out_path = _out_path(uploads_dir, out_name)
+    if SMART_SINGLE_PASS or len(file_names) > 2:
+        lengths = [intro_a] + [middle] * (len(file_names) - 2) + [None]
+        legs = list(zip([0.0] * len(lengths), lengths, adj_in, adj_out))
+        legs = _align_legs(legs, [features[name].get("beatGrid") for name in file_names], xfade)
+        _smart_single_pass(in_paths, out_path, legs, xfade, prefer_rb)
+        return out_name
+
+    # Con dos pasadas cada pista se procesa entera con el ajuste de su única transición
+    a_in, b_in = in_paths
+    (tempo_a, semi_a), (tempo_b, semi_b) = adj_out[0], adj_in[1]
+
+    # --- 1ª pasada: procesar cada pista a WAV temporal (uno por salida, para mezclas concurrentes) ---
+    a_proc = f"{out_path}._a_proc.wav"
+    b_proc = f"{out_path}._b_proc.wav"
 
     def _fa(tempo, semi, use_rb):
         base = _rubberband_or_fallback_filter(tempo, semi, use_rb)
-        return f"{base},loudnorm=I=-14:TP=-1.5:LRA=11"
-
-    # Procesar A
-    fa = _fa(tempo_a, semi_a, prefer_rb)
-    cmd_a = ["ffmpeg", "-y", "-i", a_in, "-filter:a", fa, "-ac", "2", "-ar", "44100", a_proc]
-    pa = subprocess.run(cmd_a, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if pa.returncode != 0 and prefer_rb:
-        # Reintento sin rubberband (fallback)
-        fa = _fa(tempo_a, semi_a, False)
-        cmd_a = ["ffmpeg", "-y", "-i", a_in, "-filter:a", fa, "-ac", "2", "-ar", "44100", a_proc]
-        pa = subprocess.run(cmd_a, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if pa.returncode != 0:
-        raise RuntimeError(f"FFmpeg pre-procesado A falló.\nCMD: {' '.join(cmd_a)}\nERR:\n{pa.stderr}")
-
-    # Procesar B
-    fb = _fa(tempo_b, semi_b, prefer_rb)
-    cmd_b = ["ffmpeg", "-y", "-i", b_in, "-filter:a", fb, "-ac", "2", "-ar", "44100", b_proc]
-    pb = subprocess.run(cmd_b, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if pb.returncode != 0 and prefer_rb:
-        fb = _fa(tempo_b, semi_b, False)
-        cmd_b = ["ffmpeg", "-y", "-i", b_in, "-filter:a", fb, "-ac", "2", "-ar", "44100", b_proc]
-        pb = subprocess.run(cmd_b, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if pb.returncode != 0:
-        raise RuntimeError(f"FFmpeg pre-procesado B falló.\nCMD: {' '.join(cmd_b)}\nERR:\n{pb.stderr}")
-
-    # --- 2ª pasada: crossfade y export ---
-    out_path = os.path.join(uploads_dir, MIX_NAME)
-    filter_complex = (
-        f"[0:a]atrim=0:{intro_a:.3f},afade=t=out:st={intro_a - xfade:.3f}:d={xfade:.3f}[A];"
-        f"[1:a]afade=t=in:st=0:d={xfade:.3f}[B];"
-        f"[A][B]acrossfade=d={xfade:.3f}:curve1=tri:curve2=tri,alimiter=limit=0.95"
-    )
-
-    cmd_mix = [
-        "ffmpeg", "-y",
-        "-i", a_proc, "-i", b_proc,
-        "-filter_complex", filter_complex,
-        "-c:a", "libmp3lame", "-q:a", "2",
-        out_path
-    ]
-    pm = subprocess.run(cmd_mix, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        return f"{base},{LOUDNORM}"
 
-    # Limpieza de temporales
-    try:
-        if os.path.exists(a_proc):
-            os.remove(a_proc)
-        if os.path.exists(b_proc):
-            os.remove(b_proc)
-    except Exception:
-        pass
+    def _preprocess(src, dst, tempo, semi, label, span):
+        """Una pista a WAV con tempo/tono/loudness; reintenta sin rubberband si falla."""
+        expected = ffmpeg_runner.probe_duration(src)
+        expected = expected / max(tempo, 1e-3) if expected else None
+        for use_rb in ([True, False] if prefer_rb else [False]):
+            try:
+                ffmpeg_runner.run(["-y", "-i", src, "-filter:a", _fa(tempo, semi, use_rb), "-ac", "2", "-ar", "44100", dst],
+                                  duration=expected, span=span, what=f"FFmpeg pre-procesado {label}")
+                return
+            except (ffmpeg_runner.FFmpegTimeout, ffmpeg_runner.FFmpegCancelled):
+                raise
+            except ffmpeg_runner.FFmpegError:
+                if not use_rb:
+                    raise
 
-    if pm.returncode != 0:
-        raise RuntimeError(f"FFmpeg smart mix falló.\nCMD: {' '.join(cmd_mix)}\nERR:\n{pm.stderr}")
+    try:
+        _preprocess(a_in, a_proc, tempo_a, semi_a, "A", (0.0, 35.0))
+        _preprocess(b_in, b_proc, tempo_b, semi_b, "B", (35.0, 70.0))
+
+        # --- 2ª pasada: crossfade y export ---
+        filter_complex = (
+            f"[0:a]atrim=0:{intro_a:.3f},afade=t=out:st={intro_a - xfade:.3f}:d={xfade:.3f}[A];"
+            f"[1:a]afade=t=in:st=0:d={xfade:.3f}[B];"
+            f"[A][B]acrossfade=d={xfade:.3f}:curve1=tri:curve2=tri,alimiter=limit=0.95"
+        )
+        b_len = ffmpeg_runner.probe_duration(b_proc)
+        ffmpeg_runner.run([
+            "-y",
+            "-i", a_proc, "-i", b_proc,
+            "-filter_complex", filter_complex,
+            "-c:a", "libmp3lame", "-q:a", "2",
+            out_path
+        ], duration=intro_a + b_len - xfade if b_len else None, span=(70.0, 100.0), what="FFmpeg smart mix")
+    finally:
+        # Limpieza de temporales
+        for tmp in (a_proc, b_proc):
+            try:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            except Exception:
+                pass
 
-    return MIX_NAME
+    return out_name
 
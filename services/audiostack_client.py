@@ -0,0 +1,246 @@
+# services/audiostack_client.py
+import os
+import random
+import threading
+import time
+import uuid
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+from services import metrics
+
+load_dotenv()
+
+# Cliente de la mezcla remota (Audiostack):
+#   - una sesión HTTP con pool por proceso (keep-alive entre mezclas)
+#   - subida multipart en streaming (los archivos no se cargan enteros en memoria)
+#   - descarga en streaming a disco
+#   - reintentos acotados con backoff exponencial + jitter
+#   - circuit breaker: tras varios fallos seguidos se va directo a la mezcla local durante un tiempo
+# Para probar latencias y fallos sin red: python -m services.audiostack_fake (ver ese módulo).
+AUDIOSTACK_API_KEY = (os.getenv("AUDIOSTACK_API_KEY") or "").strip().strip("'\"")
+AUDIOSTACK_ENDPOINT = (os.getenv("AUDIOSTACK_ENDPOINT") or "").strip().strip("'\"")
+AUDIOSTACK_CONNECT_TIMEOUT = float(os.getenv("AUDIOSTACK_CONNECT_TIMEOUT") or 3)
+# Tiempo máximo sin recibir bytes (no de la petición completa)
+AUDIOSTACK_READ_TIMEOUT = float(os.getenv("AUDIOSTACK_READ_TIMEOUT") or 60)
+AUDIOSTACK_RETRIES = int(os.getenv("AUDIOSTACK_RETRIES") or 2)
+AUDIOSTACK_BACKOFF_SEC = float(os.getenv("AUDIOSTACK_BACKOFF_SEC") or 0.5)
+AUDIOSTACK_BREAKER_FAILURES = int(os.getenv("AUDIOSTACK_BREAKER_FAILURES") or 3)
+AUDIOSTACK_BREAKER_COOLDOWN_SEC = float(os.getenv("AUDIOSTACK_BREAKER_COOLDOWN_SEC") or 60)
+AUDIOSTACK_POOL_SIZE = int(os.getenv("AUDIOSTACK_POOL_SIZE") or 4)
+
+_CHUNK = 1024 * 1024
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class AudiostackError(Exception):
+    pass
+
+
+class CircuitoAbierto(AudiostackError):
+    """El remoto falló varias veces seguidas: no se intenta hasta que pase el enfriamiento."""
+
+
+def endpoint_valido(url: str) -> bool:
+    if not url:
+        return False
+    u = url.lower()
+    return u.startswith("http") and "tu-endpoint" not in u and not u.startswith("<")
+
+
+def configured() -> bool:
+    return bool(AUDIOSTACK_API_KEY) and endpoint_valido(AUDIOSTACK_ENDPOINT)
+
+
+# -------------------- Circuit breaker --------------------
+class _CircuitBreaker:
+    """
+    cerrado: se llama al remoto.  abierto: se rechaza sin llamar hasta pasado cooldown.
+    semiabierto: pasado cooldown, deja pasar una única prueba; si sale bien se cierra, si no se reabre.
+    """
+
+    def __init__(self, failures, cooldown):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._opened_at = None
+        self._probing = False
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._opened_at = None
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self._probing or self._consecutive >= self.failures:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "cerrado"
+            return "semiabierto" if self._probing else "abierto"
+
+
+breaker = _CircuitBreaker(AUDIOSTACK_BREAKER_FAILURES, AUDIOSTACK_BREAKER_COOLDOWN_SEC)
+
+
+# -------------------- Sesión HTTP (una por proceso) --------------------
+_session_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+
+def _get_session() -> requests.Session:
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=AUDIOSTACK_POOL_SIZE)
+            s.mount("http://", adapter)
+            s.mount("https://", adapter)
+            _session, _session_pid = s, os.getpid()
+        return _session
+
+
+# -------------------- Multipart en streaming --------------------
+class _MultipartStream:
+    """
+    Cuerpo multipart/form-data que se lee por trozos desde disco.
+    Tiene len(): requests envía Content-Length en vez de chunked (no todos los servidores lo aceptan).
+    """
+
+    def __init__(self, fields, file_paths, field_name="files", content_type="audio/mpeg"):
+        self.boundary = uuid.uuid4().hex
+        self._parts = []  # bytes o rutas, en orden
+        for name, value in fields.items():
+            self._parts.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            )
+        for path in file_paths:
+            filename = os.path.basename(path).replace('"', "")
+            self._parts.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+                f"Content-Type: {content_type}\r\n\r\n".encode()
+            )
+            self._parts.append(path)
+            self._parts.append(b"\r\n")
+        self._parts.append(f"--{self.boundary}--\r\n".encode())
+        self._len = sum(len(p) if isinstance(p, bytes) else os.path.getsize(p) for p in self._parts)
+        self._iter = self._chunks()
+        self._cur, self._pos = b"", 0  # trozo actual y posición: sin recopiar el buffer en cada read()
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self._len
+
+    def _chunks(self):
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(_CHUNK), b""):
+                    yield chunk
+
+    def read(self, size=-1):
+        out = []
+        while size != 0:
+            if self._pos >= len(self._cur):
+                self._cur, self._pos = next(self._iter, b""), 0
+                if not self._cur:
+                    break
+            end = len(self._cur) if size < 0 else min(len(self._cur), self._pos + size)
+            out.append(self._cur[self._pos:end])
+            if size > 0:
+                size -= end - self._pos
+            self._pos = end
+        return b"".join(out)
+
+
+# -------------------- Llamada remota --------------------
+def _attempt(file_paths, out_path):
+    """Una petición. Devuelve (None, 200) si la mezcla quedó en out_path, o (error, status)."""
+    body = _MultipartStream({"mode": "mixing", "output_format": "mp3"}, file_paths)
+    headers = {"Authorization": f"Bearer {AUDIOSTACK_API_KEY}", "Content-Type": body.content_type}
+    with _get_session().post(
+        AUDIOSTACK_ENDPOINT, headers=headers, data=body, stream=True,
+        timeout=(AUDIOSTACK_CONNECT_TIMEOUT, AUDIOSTACK_READ_TIMEOUT),
+    ) as resp:
+        if resp.status_code != 200:
+            return AudiostackError(f"Error en Audiostack: {resp.status_code} - {resp.text[:500]}"), resp.status_code
+        tmp = out_path + ".part"
+        try:
+            with open(tmp, "wb") as out:
+                for chunk in resp.iter_content(chunk_size=_CHUNK):
+                    out.write(chunk)
+            os.replace(tmp, out_path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    return None, 200
+
+
+def mix(file_paths, out_path):
+    """
+    Mezcla remota de file_paths escrita en out_path.
+    Lanza CircuitoAbierto sin llamar si el remoto está marcado como caído,
+    o AudiostackError tras agotar los reintentos.
+    """
+    if not configured():
+        raise AudiostackError("Audiostack no está configurado.")
+    if not breaker.allow():
+        metrics.event("audiostack_circuit_open")
+        raise CircuitoAbierto("Audiostack no responde; se usa la mezcla local.")
+
+    # El resultado se anota siempre (también con excepciones inesperadas): si no, una prueba
+    # semiabierta fallida dejaría el circuito rechazando llamadas para siempre
+    ok = False
+    try:
+        last = None
+        for attempt in range(AUDIOSTACK_RETRIES + 1):
+            if attempt:
+                metrics.event("audiostack_retry")
+                time.sleep(AUDIOSTACK_BACKOFF_SEC * 2 ** (attempt - 1) * (0.5 + random.random()))
+            try:
+                with metrics.span("audiostack.request"):
+                    err, status = _attempt(file_paths, out_path)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                last = AudiostackError(f"Error en Audiostack: {e}")
+                continue
+            except (requests.RequestException, OSError) as e:
+                # Corte a mitad de la descarga, disco lleno...: no se reintenta, pero sí hay fallback local
+                last = AudiostackError(f"Error en Audiostack: {e}")
+                break
+            if err is None:
+                ok = True
+                return out_path
+            last = err
+            if status not in _RETRY_STATUS:
+                break
+        raise last
+    finally:
+        if ok:
+            breaker.success()
+        else:
+            breaker.failure()
@@ -0,0 +1,109 @@
+# services/audiostack_fake.py
+"""
+Servidor local que imita el endpoint de mezcla de Audiostack, para probar sin red
+latencias, errores y cortes del cliente (audiostack_client) y su fallback a la mezcla local.
+
+    python -m services.audiostack_fake --port 8765 --latency 2 --fail-rate 0.3
+    AUDIOSTACK_ENDPOINT=http://127.0.0.1:8765/mix AUDIOSTACK_API_KEY=fake flask run
+
+Responde con el primer archivo recibido como "mezcla". Desde Python: serve_in_thread(...).
+"""
+import argparse
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_CHUNK = 64 * 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Opciones del servidor (se fijan en make_server)
+    latency = 0.0      # segundos antes de responder
+    fail_rate = 0.0    # probabilidad de responder fail_status
+    fail_status = 503
+    hang = False       # no responder nunca (para probar el read timeout)
+    api_key = None     # si se indica, exige "Authorization: Bearer <api_key>"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = bytearray()
+        while len(body) < length:
+            chunk = self.rfile.read(min(_CHUNK, length - len(body)))
+            if not chunk:
+                break
+            body += chunk
+        self.server.requests_seen += 1
+
+        if self.api_key and self.headers.get("Authorization") != f"Bearer {self.api_key}":
+            return self._reply(401, b"unauthorized")
+        if self.hang:
+            time.sleep(3600)
+        time.sleep(self.latency)
+        if random.random() < self.fail_rate:
+            return self._reply(self.fail_status, b"fake failure")
+
+        audio = _first_file(bytes(body), self.headers.get("Content-Type", ""))
+        if audio is None:
+            return self._reply(400, b"no files")
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Content-Length", str(len(audio)))
+        self.end_headers()
+        for i in range(0, len(audio), _CHUNK):
+            self.wfile.write(audio[i:i + _CHUNK])
+
+    def _reply(self, status, payload):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def _first_file(body: bytes, content_type: str):
+    """Contenido de la primera parte con filename= del multipart (parser mínimo)."""
+    if "boundary=" not in content_type:
+        return None
+    boundary = b"--" + content_type.split("boundary=", 1)[1].strip().encode()
+    for part in body.split(boundary):
+        head, sep, data = part.partition(b"\r\n\r\n")
+        if sep and b"filename=" in head:
+            return data[:-2] if data.endswith(b"\r\n") else data
+    return None
+
+
+def make_server(host="127.0.0.1", port=0, latency=0.0, fail_rate=0.0, fail_status=503, hang=False, api_key=None):
+    handler = type("Handler", (_Handler,), {
+        "latency": latency, "fail_rate": fail_rate, "fail_status": fail_status, "hang": hang, "api_key": api_key,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.requests_seen = 0
+    return server
+
+
+def serve_in_thread(**options):
+    """Arranca el servidor en segundo plano. Devuelve (server, url); server.shutdown() para pararlo."""
+    server = make_server(**options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}/mix"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Audiostack falso para pruebas locales")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--fail-status", type=int, default=503)
+    parser.add_argument("--hang", action="store_true")
+    parser.add_argument("--api-key")
+    args = parser.parse_args()
+    srv = make_server(args.host, args.port, args.latency, args.fail_rate, args.fail_status, args.hang, args.api_key)
+    print(f"Audiostack falso en http://{args.host}:{args.port}/mix")
+    srv.serve_forever()
@@ -0,0 +1,138 @@
+# services/blob_store.py
+import errno
+import os
+import shutil
+import time
+import uuid
+
+# Almacén por contenido dentro de uploads: cada contenido distinto se guarda una vez en
+#   blobs/<sha[:2]>/<sha>
+# y los nombres visibles (pistas, mezclas guardadas) son enlaces duros a ese blob.
+# El contador de referencias es el propio st_nlink: un blob con st_nlink == 1 ya no lo usa nadie.
+BLOBS_DIR = "blobs"
+# Un blob recién creado no se recoge hasta pasado este margen (puede estar a punto de enlazarse)
+BLOB_GC_GRACE_SEC = int(os.getenv("BLOB_GC_GRACE_SEC") or 3600)
+
+# Errores de os.link que significan "este sistema de archivos no enlaza": se copia
+_NO_LINK = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP}
+
+
+def blob_path(uploads_dir: str, sha: str) -> str:
+    return os.path.join(uploads_dir, BLOBS_DIR, sha[:2], sha)
+
+
+def _link_or_copy(src: str, dest: str):
+    """Enlace duro atómico src -> dest (sustituye dest si existía); copia si no se puede enlazar."""
+    tmp = f"{dest}.{uuid.uuid4().hex}.part"  # único: dos subidas iguales pueden crear el mismo blob a la vez
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        if e.errno not in _NO_LINK:
+            raise
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+def put(uploads_dir: str, path: str, sha: str, copy: bool = False) -> str:
+    """
+    Asegura que el contenido de path (con hash sha) está en el almacén y devuelve la ruta del blob.
+    copy=True para orígenes que se reescriben en el mismo inodo (p.ej. mix_ia_final.mp3 con ffmpeg -y):
+    un enlace haría que la siguiente mezcla pisara el blob.
+    """
+    blob = blob_path(uploads_dir, sha)
+    if os.path.exists(blob):
+        return blob
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    if copy:
+        tmp = f"{blob}.{uuid.uuid4().hex}.part"
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, blob)
+    else:
+        _link_or_copy(path, blob)
+    return blob
+
+
+def link(uploads_dir: str, sha: str, dest_name: str, source: str = None, copy: bool = False) -> str:
+    """
+    Crea dest_name (relativo a uploads) como enlace al blob de sha, O(1) si el blob ya existe.
+    source: archivo con ese contenido, para crear el blob si todavía no existe.
+    """
+    dest = os.path.join(uploads_dir, dest_name)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    for _ in range(3):
+        blob = put(uploads_dir, source, sha, copy=copy) if source else blob_path(uploads_dir, sha)
+        try:
+            _link_or_copy(blob, dest)
+            return dest_name
+        except FileNotFoundError:
+            # El GC lo recogió entre put y link: se vuelve a crear
+            if not source:
+                raise
+    raise RuntimeError(f"No se pudo enlazar el blob {sha}.")
+
+
+def adopt(uploads_dir: str, path: str, sha: str) -> bool:
+    """
+    Lleva un archivo recién escrito (nombre único, no se reescribe) al almacén.
+    Si el contenido ya estaba, path pasa a ser otro enlace al blob existente y sus bytes se liberan.
+    Devuelve True si se ha deduplicado.
+    """
+    blob = blob_path(uploads_dir, sha)
+    if os.path.exists(blob) and not os.path.samefile(blob, path):
+        try:
+            _link_or_copy(blob, path)
+            return True
+        except FileNotFoundError:
+            pass
+    put(uploads_dir, path, sha)
+    return False
+
+
+def collect(uploads_dir: str, sha: str) -> bool:
+    """Borra el blob de sha si ya no lo referencia ningún nombre. Devuelve True si se borró."""
+    blob = blob_path(uploads_dir, sha)
+    try:
+        if os.stat(blob).st_nlink > 1:
+            return False
+        os.remove(blob)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def gc(uploads_dir: str, grace_sec: int = None) -> tuple[int, int]:
+    """
+    Recoge los blobs sin referencias (st_nlink == 1) cuyo último cambio de enlaces (ctime)
+    sea anterior a grace_sec. Devuelve (blobs borrados, bytes liberados).
+    """
+    grace_sec = BLOB_GC_GRACE_SEC if grace_sec is None else grace_sec
+    root = os.path.join(uploads_dir, BLOBS_DIR)
+    if not os.path.isdir(root):
+        return 0, 0
+    limit = time.time() - grace_sec
+    removed = freed = 0
+    for shard in os.scandir(root):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            # También los .part que dejó una escritura interrumpida
+            if (st.st_nlink == 1 or entry.name.endswith(".part")) and st.st_ctime < limit:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    continue
+                removed += 1
+                freed += st.st_size
+    return removed, freed
+
+
+if __name__ == "__main__":
+    # python -m services.blob_store [directorio_uploads]
+    import sys
+
+    uploads = sys.argv[1] if len(sys.argv) > 1 else os.path.join("static", "uploads")
+    n, size = gc(uploads)
+    print(f"Blobs recogidos: {n} ({size / 1024 / 1024:.1f} MB liberados)")
@@ -0,0 +1,141 @@
+# services/export_service.py
+import hashlib
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+
+from services import ffmpeg_runner, mix_cache
+
+# Exportación de la mezcla en otros formatos. Cada (mezcla, formato, calidad) se transcodifica
+# una sola vez y queda en EXPORT_DIR con expulsión LRU propia (no compite con las mezclas).
+EXPORT_DIR = "cache/export"
+EXPORT_CACHE_MAX_MB = int(os.getenv("EXPORT_CACHE_MAX_MB") or 2048)
+
+# formato -> extensión, mimetype, calidad por defecto y argumentos de FFmpeg por calidad
+FORMATS = {
+    "mp3": {
+        "ext": ".mp3", "mimetype": "audio/mpeg", "default": "original",
+        "qualities": {
+            "original": None,  # la mezcla ya es MP3: se sirve tal cual, sin recodificar
+            "320": ["-c:a", "libmp3lame", "-b:a", "320k"],
+            "192": ["-c:a", "libmp3lame", "-b:a", "192k"],
+            "128": ["-c:a", "libmp3lame", "-b:a", "128k"],
+        },
+    },
+    "aac": {
+        "ext": ".m4a", "mimetype": "audio/mp4", "default": "256",
+        "qualities": {
+            "256": ["-c:a", "aac", "-b:a", "256k", "-movflags", "+faststart"],
+            "192": ["-c:a", "aac", "-b:a", "192k", "-movflags", "+faststart"],
+            "128": ["-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart"],
+        },
+    },
+    "flac": {
+        "ext": ".flac", "mimetype": "audio/flac", "default": "16",
+        "qualities": {
+            "16": ["-c:a", "flac", "-sample_fmt", "s16", "-compression_level", "5"],
+            "24": ["-c:a", "flac", "-sample_fmt", "s32", "-bits_per_raw_sample", "24", "-compression_level", "5"],
+        },
+    },
+    "wav": {
+        "ext": ".wav", "mimetype": "audio/wav", "default": "16",
+        "qualities": {
+            "16": ["-c:a", "pcm_s16le"],
+            "24": ["-c:a", "pcm_s24le"],
+        },
+    },
+}
+
+_locks_guard = threading.Lock()
+# clave de exportación -> [Lock, usuarios]: dos peticiones iguales no transcodifican dos veces;
+# la entrada se borra cuando nadie la usa (el dict no crece con cada mezcla y formato)
+_locks = {}
+
+
+class FormatoNoSoportado(ValueError):
+    pass
+
+
+def resolve(fmt: str, quality: str = None):
+    """Normaliza (formato, calidad); lanza FormatoNoSoportado si no existen."""
+    fmt = (fmt or "mp3").strip().lower()
+    spec = FORMATS.get(fmt)
+    if spec is None:
+        raise FormatoNoSoportado(f"Formato no soportado: {fmt}")
+    quality = (quality or spec["default"]).strip().lower()
+    if quality not in spec["qualities"]:
+        raise FormatoNoSoportado(f"Calidad no soportada para {fmt}: {quality}")
+    return fmt, quality
+
+
+def mimetype(fmt: str) -> str:
+    return FORMATS[fmt]["mimetype"]
+
+
+def extension(fmt: str) -> str:
+    return FORMATS[fmt]["ext"]
+
+
+@contextmanager
+def _key_lock(key: str):
+    with _locks_guard:
+        entry = _locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _locks[key]
+
+
+def export(uploads_dir: str, mix_name: str, fmt: str, quality: str = None) -> str:
+    """
+    Devuelve el nombre (relativo a uploads) de la mezcla en el formato pedido,
+    transcodificándola sólo si no está ya en la caché de exportación.
+    """
+    fmt, quality = resolve(fmt, quality)
+    args = FORMATS[fmt]["qualities"][quality]
+    src = os.path.join(uploads_dir, mix_name)
+    if args is None:
+        return mix_name
+
+    # Clave por contenido: la misma mezcla guardada con otro nombre reutiliza el transcode
+    key = hashlib.sha256(f"{mix_cache.file_sha256(src)}:{fmt}:{quality}".encode()).hexdigest()
+    name = f"{EXPORT_DIR}/{key}{extension(fmt)}"
+    dest = os.path.join(uploads_dir, name)
+
+    with _key_lock(key):
+        try:
+            os.utime(dest)  # acierto: marca el uso para el LRU
+            return name
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # El candado es por proceso: otro worker de Gunicorn puede estar exportando lo mismo a la vez
+        tmp = f"{dest}.{uuid.uuid4().hex}.part"
+        try:
+            ffmpeg_runner.run(["-y", "-loglevel", "error", "-i", src, "-vn", *args, "-f", _muxer(fmt), tmp],
+                              duration=ffmpeg_runner.probe_duration(src), what=f"Exportación a {fmt}")
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if os.path.exists(dest):
+            # Otro worker terminó antes: su archivo es el mismo contenido, se usa ése
+            os.remove(tmp)
+            os.utime(dest)
+            return name
+        os.replace(tmp, dest)
+
+    mix_cache.evict(os.path.dirname(dest), EXPORT_CACHE_MAX_MB * 1024 * 1024, keep=dest,
+                     suffixes=[spec["ext"] for spec in FORMATS.values()])
+    return name
+
+
+def _muxer(fmt: str) -> str:
+    # El archivo temporal acaba en ".part": el contenedor se indica explícitamente
+    return {"mp3": "mp3", "aac": "ipod", "flac": "flac", "wav": "wav"}[fmt]
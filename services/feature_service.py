@@ -1,28 +1,129 @@
-import io, json, librosa, numpy as np, soundfile as sf
+import io, json, logging, os
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from services import metrics
+
+# librosa, NumPy y soundfile se importan dentro de cada función: los workers web arrancan sin
+# cargarlos (ni compilar con numba) y sólo los paga el proceso que analiza de verdad.
+
+# Procesos para analizar subidas en lote (por defecto, uno por núcleo)
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS") or os.cpu_count() or 1)
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+log = logging.getLogger(__name__)
+
+# Perfiles de análisis: frecuencia de muestreo, fragmento analizado y hop de STFT/onsets.
+#   excerpt: "start" = desde el principio, "middle" = centrado en la pista (evita intros sin ritmo)
+# Medido con extract_features sobre una pista sintética de 180 s (124 BPM, acorde de La), 1 núcleo:
+#   fast 0.53 s · balanced 1.47 s · accurate 4.59 s — los tres dan 123.05 BPM, tonalidad A.
+#   Los MFCC/chroma cambian algo con la sr: no mezclar perfiles al comparar similitud.
+ANALYSIS_PROFILES = {
+    "fast":     {"sr": 11025, "seconds": 60,   "excerpt": "middle", "hop_length": 256},
+    "balanced": {"sr": 22050, "seconds": 120,  "excerpt": "start",  "hop_length": 512},
+    "accurate": {"sr": 44100, "seconds": None, "excerpt": "start",  "hop_length": 512},
+}
+# Perfil para la ingesta (/mezcla/upload); "fast" alivia la carga en picos
+ANALYSIS_PROFILE = (os.getenv("ANALYSIS_PROFILE") or "accurate").strip().lower()
+
+def get_profile(name=None):
+    """(nombre, ajustes) del perfil pedido (ANALYSIS_PROFILE si no se indica); un nombre desconocido usa "accurate"."""
+    name = (name or ANALYSIS_PROFILE).lower()
+    if name not in ANALYSIS_PROFILES:
+        name = "accurate"
+    return name, ANALYSIS_PROFILES[name]
+
+# Pistas más largas que esto (p.ej. sesiones de DJ) se analizan por bloques con memoria acotada
+STREAMING_MIN_SECONDS = float(os.getenv("STREAMING_MIN_SECONDS") or 900)
+STREAM_BLOCK_FRAMES = 256
+STREAM_N_FFT = 2048
+# El tempograma crece con la longitud: el tempo se estima por tramos (~50 s) y se toma la mediana
+STREAM_TEMPO_FRAMES = 2048
+
+def load_for_analysis(path: str, profile: dict):
+    """Decodifica sólo el fragmento del perfil. Devuelve (y, sr, offset_en_segundos)."""
+    import librosa
+    offset = 0.0
+    seconds = profile["seconds"]
+    if seconds and profile["excerpt"] == "middle":
+        offset = max(0.0, (calc_duration_seconds(path) - seconds) / 2)
+    with metrics.span("analysis.decode"):
+        y, sr = librosa.load(path, sr=profile["sr"], mono=True, offset=offset, duration=seconds)
+    return y, sr, offset
 
 def calc_duration_seconds(path: str) -> float:
+    import soundfile as sf
     f = sf.SoundFile(path)
     return float(len(f) / f.samplerate)
 
-def extract_features(path: str):
-    # 44.1kHz mono para análisis (no altera archivo original)
-    y, sr = librosa.load(path, sr=44100, mono=True)
-    # BPM
-    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
-    bpm = float(tempo)
+def beat_grid(y, sr, beat_frames, onset_env=None, hop_length=512, offset=0.0, excerpt=None):
+    """
+    Rejilla de beats compacta para guardar con las features:
+      beatsMs (int, ms), firstDownbeatMs (beat del compás con más ataque), confidence (0–1, regularidad)
+      y rangeMs [inicio, fin]: tramo de la pista analizado (fuera de él la rejilla no dice nada).
+    excerpt: (inicio, fin) en segundos; por defecto, el fragmento y que empieza en offset.
+    """
+    import librosa
+    import numpy as np
+    beat_frames = np.asarray(beat_frames, dtype=int)
+    if beat_frames.size < 2:
+        return None
+    times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=hop_length) + offset
+    if excerpt is None:
+        excerpt = (offset, offset + len(y) / sr)
+    if onset_env is None:
+        onset_env = librosa.onset.onset_strength(y=y, sr=sr, hop_length=hop_length)
+    # Downbeat: de las 4 fases posibles del compás, la que acumula más energía de ataque
+    strength = onset_env[np.clip(beat_frames, 0, len(onset_env) - 1)]
+    phase = int(np.argmax([strength[p::4].sum() for p in range(min(4, len(strength)))]))
+    ibi = np.diff(times)
+    confidence = float(np.clip(1.0 - ibi.std() / (ibi.mean() + 1e-9), 0, 1))
+    return {
+        "beatsMs": [int(round(t * 1000)) for t in times],
+        "firstDownbeatMs": int(round(times[phase] * 1000)),
+        "confidence": round(confidence, 3),
+        "rangeMs": [int(round(excerpt[0] * 1000)), int(round(excerpt[1] * 1000))],
+    }
+
+def extract_features(path: str, profile: str = None):
+    import librosa
+    import numpy as np
+    # Mono, con la resolución del perfil (no altera archivo original)
+    profile_name, prof = get_profile(profile)
+    hop = prof["hop_length"]
+    if prof["seconds"] is None:
+        try:
+            long_track = calc_duration_seconds(path) > STREAMING_MIN_SECONDS
+        except Exception:
+            long_track = False  # formato que soundfile no lee: no se puede streamear
+        if long_track:
+            return extract_features_streaming(path, profile_name)
+    y, sr, offset = load_for_analysis(path, prof)
+    # BPM + rejilla de beats (se guarda para alinear transiciones sin volver a hacer beat tracking)
+    with metrics.span("analysis.beats"):
+        onset_env = librosa.onset.onset_strength(y=y, sr=sr, hop_length=hop)
+        tempo, beats = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr, hop_length=hop)
+        bpm = float(np.atleast_1d(tempo)[0])
+        grid = beat_grid(y, sr, beats, onset_env, hop_length=hop, offset=offset)
     # Chroma (para tonalidad aproximada)
-    chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
-    chroma_mean = chroma.mean(axis=1)
+    with metrics.span("analysis.chroma_cqt"):
+        chroma = librosa.feature.chroma_cqt(y=y, sr=sr, hop_length=hop)
+        chroma_mean = chroma.mean(axis=1)
     # heurística simple de key (índice máx del chroma)
     pitch_classes = ['C','C#','D','D#','E','F','F#','G','G#','A','A#','B']
     key_idx = int(np.argmax(chroma_mean))
     musical_key = pitch_classes[key_idx]  # mayor aproximado (suficiente para demo)
-    # Energía RMS normalizada
-    rms = librosa.feature.rms(y=y).mean()
-    energy = float(np.clip(rms / (np.max(np.abs(y)) + 1e-9), 0, 1))
-    # MFCC medios
-    mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
-    mfcc_mean = mfcc.mean(axis=1)
+    with metrics.span("analysis.timbre"):
+        # Energía RMS normalizada
+        rms = librosa.feature.rms(y=y, hop_length=hop).mean()
+        energy = float(np.clip(rms / (np.max(np.abs(y)) + 1e-9), 0, 1))
+        # MFCC medios
+        mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13, hop_length=hop)
+        mfcc_mean = mfcc.mean(axis=1)
 
     return {
         "bpm": bpm,
@@ -30,4 +131,160 @@ def extract_features(path: str):
         "energy": energy,
         "mfccMean": [float(x) for x in mfcc_mean],
         "chromaMean": [float(x) for x in chroma_mean],
+        "beatGrid": grid,
+        "analysisProfile": profile_name,
+    }
+
+@metrics.timed("analysis.streaming")
+def extract_features_streaming(path: str, profile: str = None):
+    """
+    Mismas features que extract_features, leyendo el archivo por bloques (librosa.stream):
+    la memoria no depende de la duración (sólo crecen la envolvente de onsets, ~4 bytes por frame,
+    y la lista de beats).
+    Trabaja a la sr nativa del archivo. Energía, MFCC y chroma se calculan como en extract_features
+    (RMS de la señal, dB con top_db=80, chroma CQT) para que ambos caminos sean comparables en similitud.
+    """
+    import librosa
+    import numpy as np
+    import soundfile as sf
+    profile_name, prof = get_profile(profile)
+    hop, n_fft = prof["hop_length"], STREAM_N_FFT
+    info = sf.info(path)
+    sr = info.samplerate
+    mel_fb = librosa.filters.mel(sr=sr, n_fft=n_fft)
+
+    onset_parts, prev_db = [], None
+    mfcc_sum, chroma_sum = np.zeros(13), np.zeros(12)
+    rms_sum, peak, n_frames, chroma_frames = 0.0, 0.0, 0, 0
+    for y_block in librosa.stream(path, block_length=STREAM_BLOCK_FRAMES, frame_length=n_fft,
+                                  hop_length=hop, mono=True, fill_value=0):
+        peak = max(peak, float(np.max(np.abs(y_block))))
+        S = np.abs(librosa.stft(y_block, n_fft=n_fft, hop_length=hop, center=False))
+        power = S ** 2
+        # Mismo recorte que librosa.feature.mfcc(y=...) y onset_strength (top_db=80, aquí por bloque)
+        mel_db = librosa.power_to_db(mel_fb @ power, top_db=80.0)
+        # Onset: flujo espectral positivo, enlazado con el último frame del bloque anterior
+        full = mel_db if prev_db is None else np.hstack([prev_db, mel_db])
+        flux = np.maximum(0.0, np.diff(full, axis=1)).mean(axis=0)
+        onset_parts.append(np.concatenate([[0.0], flux]) if prev_db is None else flux)
+        prev_db = mel_db[:, -1:]
+
+        mfcc_sum += librosa.feature.mfcc(S=mel_db, n_mfcc=13).sum(axis=1)
+        chroma = librosa.feature.chroma_cqt(y=y_block, sr=sr, hop_length=hop)
+        chroma_sum += chroma.sum(axis=1)
+        chroma_frames += chroma.shape[1]
+        # RMS en el dominio del tiempo (sin la ventana de Hann de la STFT), como en extract_features
+        rms_sum += float(librosa.feature.rms(y=y_block, frame_length=n_fft, hop_length=hop, center=False).sum())
+        n_frames += S.shape[1]
+
+    if n_frames == 0:
+        raise ValueError("Archivo de audio vacío.")
+    onset_env = np.concatenate(onset_parts).astype(np.float32)
+    tempos = [
+        float(librosa.feature.tempo(onset_envelope=onset_env[i:i + STREAM_TEMPO_FRAMES], sr=sr, hop_length=hop)[0])
+        for i in range(0, len(onset_env), STREAM_TEMPO_FRAMES)
+        if len(onset_env) - i >= STREAM_TEMPO_FRAMES // 4 or i == 0
+    ]
+    tempo = float(np.median(tempos))
+    # Con el tempo fijado, el seguimiento de beats es un DP lineal sin tempograma
+    _, beats = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr, hop_length=hop, bpm=tempo)
+    # center=False: el frame i está centrado en i*hop + n_fft/2
+    grid = beat_grid(None, sr, beats, onset_env, hop_length=hop, offset=n_fft / (2 * sr),
+                     excerpt=(0.0, info.duration))  # n_frames * hop contaría el relleno del último bloque
+    chroma_mean = chroma_sum / max(chroma_frames, 1)
+    pitch_classes = ['C','C#','D','D#','E','F','F#','G','G#','A','A#','B']
+    return {
+        "bpm": tempo,
+        "musicalKey": pitch_classes[int(np.argmax(chroma_mean))],
+        "energy": float(np.clip((rms_sum / n_frames) / (peak + 1e-9), 0, 1)),
+        "mfccMean": [float(x) for x in mfcc_sum / n_frames],
+        "chromaMean": [float(x) for x in chroma_mean],
+        "beatGrid": grid,
+        "analysisProfile": f"{profile_name}-stream",
     }
+
+def analyze_file(path: str):
+    """Duración + features de un archivo (unidad de trabajo del pool); de paso, sus picos de forma de onda."""
+    from services.waveform_service import generate_peaks
+    try:
+        with metrics.span("analysis.peaks"):
+            generate_peaks(path)
+    except Exception as e:
+        log.warning("No se pudieron generar los picos de %s: %s", path, e)
+    with metrics.span("analysis.extract"):
+        return calc_duration_seconds(path), extract_features(path)
+
+def _preload():
+    """Inicializador de los procesos del pool: cargan las dependencias pesadas al arrancar, no en la primera pista."""
+    import librosa, numpy, soundfile  # noqa: F401
+
+def get_pool():
+    # "spawn": librosa/numba no se llevan bien con fork; el pool se reutiliza entre peticiones
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            ctx = multiprocessing.get_context("spawn")
+            _pool = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS, mp_context=ctx, initializer=_preload)
+            _pool_pid = os.getpid()
+        return _pool
+
+def _discard_pool(broken):
+    """Olvida un pool roto (un hijo murió, p.ej. por OOM) para que get_pool() cree otro."""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def submit(fn, *args):
+    """Envía fn(*args) al pool de análisis; si el pool está roto lo recrea y lo intenta una vez más."""
+    pool = get_pool()
+    try:
+        return pool.submit(fn, *args)
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        return get_pool().submit(fn, *args)
+
+def analyze_many(paths):
+    """
+    Analiza varios archivos en paralelo en un pool de procesos.
+    Devuelve una lista en el mismo orden: (duración, features) o la excepción de ese archivo.
+    """
+    if len(paths) <= 1 or ANALYSIS_WORKERS <= 1:
+        results = []
+        for p in paths:
+            try:
+                results.append(analyze_file(p))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    # Los spans medidos en los procesos hijos vuelven con el resultado (metrics.collected)
+    futures = []
+    for p in paths:
+        try:
+            futures.append(submit(metrics.collected, analyze_file, p))
+        except Exception as e:
+            futures.append(e)
+    results = []
+    for p, fut in zip(paths, futures):
+        for retry in (True, False):
+            try:
+                if isinstance(fut, Exception):
+                    raise fut
+                result, samples = fut.result()
+                metrics.merge(samples)
+                results.append(result)
+            except BrokenProcessPool as e:
+                # Si un hijo muere, todo lo pendiente del pool falla: se reenvía una vez a un pool nuevo
+                if retry:
+                    try:
+                        fut = submit(metrics.collected, analyze_file, p)
+                        continue
+                    except Exception as e2:
+                        e = e2
+                results.append(e)
+            except Exception as e:
+                results.append(e)
+            break
+    return results
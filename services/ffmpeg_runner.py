@@ -0,0 +1,206 @@
+# services/ffmpeg_runner.py
+import collections
+import functools
+import os
+import shutil
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+from services import metrics
+
+# Única capa de ejecución de FFmpeg del servicio:
+#   - capacidades (binario, filtros, encoders) sondeadas una vez por proceso
+#   - límite de tiempo y de hilos por ejecución
+#   - progreso a partir de -progress (porcentaje si se conoce la duración de la salida)
+#   - cancelación desde el trabajo que la lanzó (ver job_service.cancel)
+FFMPEG_BIN = os.getenv("FFMPEG_BIN") or "ffmpeg"
+FFPROBE_BIN = os.getenv("FFPROBE_BIN") or "ffprobe"
+FFMPEG_TIMEOUT_SEC = float(os.getenv("FFMPEG_TIMEOUT_SEC") or 900)
+# 0 = lo que decida FFmpeg (todos los núcleos); con varios MIX_WORKERS conviene acotarlo
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS") or 2)
+_STDERR_TAIL_LINES = 200
+_POLL_SEC = 0.2
+
+
+class FFmpegError(RuntimeError):
+    def __init__(self, message, cmd=None, stderr=""):
+        super().__init__(f"{message}\nCMD: {' '.join(cmd or [])}\nERR:\n{stderr}" if cmd else message)
+        self.cmd = cmd
+        self.stderr = stderr
+
+
+class FFmpegTimeout(FFmpegError):
+    pass
+
+
+class FFmpegCancelled(FFmpegError):
+    pass
+
+
+# -------------------- Capacidades (cacheadas por proceso) --------------------
+@functools.lru_cache(maxsize=None)
+def available() -> bool:
+    if shutil.which(FFMPEG_BIN) is None:
+        return False
+    try:
+        subprocess.run([FFMPEG_BIN, "-version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True, timeout=10)
+        return True
+    except Exception:
+        return False
+
+
+def _list_names(flag: str) -> frozenset:
+    """Nombres de la tabla de `ffmpeg -filters` / `-encoders` (2ª columna)."""
+    if not available():
+        return frozenset()
+    try:
+        out = subprocess.run([FFMPEG_BIN, "-hide_banner", flag], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, text=True, timeout=10).stdout
+    except Exception:
+        return frozenset()
+    # Filas "<flags> <nombre> ...": las de la leyenda ("T.. = Timeline support") sólo añaden "="
+    return frozenset(cols[1] for cols in map(str.split, out.splitlines()) if len(cols) >= 2)
+
+
+@functools.lru_cache(maxsize=None)
+def _filters() -> frozenset:
+    return _list_names("-filters")
+
+
+@functools.lru_cache(maxsize=None)
+def _encoders() -> frozenset:
+    return _list_names("-encoders")
+
+
+def has_filter(name: str) -> bool:
+    return name in _filters()
+
+
+def has_encoder(name: str) -> bool:
+    return name in _encoders()
+
+
+# Duraciones memorizadas (LRU): las de archivos borrados o cambiados acaban saliendo solas
+PROBE_MEMO_SIZE = 4096
+
+
+def probe_duration(path: str):
+    """Duración en segundos (ffprobe), memorizada por (ruta, tamaño, mtime). None si no se puede."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return _probe_duration(path, st.st_size, st.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=PROBE_MEMO_SIZE)
+def _probe_duration(path: str, size: int, mtime_ns: int):
+    if not shutil.which(FFPROBE_BIN):
+        return None
+    try:
+        out = subprocess.run(
+            [FFPROBE_BIN, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=30,
+        ).stdout.strip()
+        return float(out) if out and out != "N/A" else None
+    except Exception:
+        return None
+
+
+# -------------------- Contexto del trabajo --------------------
+_ctx = threading.local()
+
+
+@contextmanager
+def job_context(on_progress=None, cancel_event=None):
+    """
+    Asocia progreso y cancelación a todas las ejecuciones de FFmpeg de este hilo
+    (p.ej. las tres pasadas del modo smart) sin pasarlos por cada función intermedia.
+    """
+    prev = getattr(_ctx, "value", None)
+    _ctx.value = (on_progress, cancel_event)
+    try:
+        yield
+    finally:
+        _ctx.value = prev
+
+
+# -------------------- Ejecución --------------------
+def run(args, duration=None, span=(0.0, 100.0), timeout=None, threads=None, what="FFmpeg"):
+    """
+    Ejecuta `ffmpeg <args>` (sin el binario; el último argumento es la salida).
+    duration: segundos esperados de salida, para convertir el progreso en porcentaje.
+    span: tramo del progreso total del trabajo que cubre esta ejecución (p.ej. una de varias pasadas).
+    Lanza FFmpegTimeout, FFmpegCancelled o FFmpegError (con las últimas líneas de stderr).
+    """
+    with metrics.span("ffmpeg", what=what):
+        return _run(args, duration, span, timeout, threads, what)
+
+
+def _run(args, duration, span, timeout, threads, what):
+    if not available():
+        raise FFmpegError("FFmpeg no está instalado o no está en el PATH.")
+    on_progress, cancel_event = getattr(_ctx, "value", None) or (None, None)
+    if cancel_event is not None and cancel_event.is_set():
+        raise FFmpegCancelled(f"{what} cancelado.")
+
+    threads = FFMPEG_THREADS if threads is None else threads
+    timeout = FFMPEG_TIMEOUT_SEC if timeout is None else timeout
+    cmd = [FFMPEG_BIN, "-hide_banner", "-nostdin", "-nostats", "-progress", "pipe:1"]
+    if threads > 0:
+        cmd += ["-filter_threads", str(threads), "-filter_complex_threads", str(threads)]
+    cmd += list(args)
+    if threads > 0:
+        # -threads como opción de salida: limita también al encoder
+        cmd[-1:-1] = ["-threads", str(threads)]
+
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            text=True, bufsize=1)
+    # stderr se drena aparte y sólo se guarda la cola: sin buffers ilimitados ni bloqueos por pipe lleno
+    tail = collections.deque(maxlen=_STDERR_TAIL_LINES)
+    drain = threading.Thread(target=lambda: tail.extend(proc.stderr), daemon=True)
+    drain.start()
+
+    stop = {"reason": None}
+
+    def _watch():
+        deadline = time.monotonic() + timeout if timeout > 0 else None
+        while proc.poll() is None:
+            if cancel_event is not None and cancel_event.wait(_POLL_SEC):
+                stop["reason"] = "cancel"
+            elif cancel_event is None:
+                time.sleep(_POLL_SEC)
+            if stop["reason"] is None and deadline is not None and time.monotonic() > deadline:
+                stop["reason"] = "timeout"
+            if stop["reason"]:
+                proc.kill()
+                return
+
+    watcher = threading.Thread(target=_watch, daemon=True)
+    watcher.start()
+
+    lo, hi = span
+    for line in proc.stdout:
+        key, _, value = line.strip().partition("=")
+        if on_progress is None:
+            continue
+        if key == "out_time_us" and value.isdigit() and duration:
+            # La duración es una estimación: no se da por terminado hasta "progress=end"
+            frac = min(0.99, int(value) / 1e6 / duration)
+            on_progress(lo + frac * (hi - lo))
+        elif key == "progress" and value == "end":
+            on_progress(hi)
+    proc.wait()
+    watcher.join()
+    drain.join(timeout=1)
+
+    stderr = "".join(tail)
+    if stop["reason"] == "cancel":
+        raise FFmpegCancelled(f"{what} cancelado.", cmd, stderr)
+    if stop["reason"] == "timeout":
+        raise FFmpegTimeout(f"{what} superó el límite de {timeout:g} s.", cmd, stderr)
+    if proc.returncode != 0:
+        raise FFmpegError(f"{what} falló.", cmd, stderr)
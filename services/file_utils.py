@@ -1,6 +1,9 @@
 import hashlib, os, time
 from werkzeug.utils import secure_filename
 
+from services import metrics
+
+@metrics.timed("upload.hash")
 def sha256_fileobj(fobj):
     pos = fobj.tell()
     fobj.seek(0)
@@ -10,11 +13,32 @@ def sha256_fileobj(fobj):
     fobj.seek(pos)
     return h.hexdigest()
 
-def save_unique(file_storage, uploads_dir: str) -> tuple[str, str]:
-    # retorna (stored_name, full_path)
+INGEST_BUFSIZE = 1024 * 1024
+
+@metrics.timed("upload.save")
+def save_unique_hashed(file_storage, uploads_dir: str, bufsize: int = INGEST_BUFSIZE) -> tuple[str, str, str]:
+    # retorna (stored_name, full_path, sha256): hash y escritura en UNA sola lectura del stream
     ts = int(time.time())
-    stored = f"{ts}_{secure_filename(file_storage.filename)}"
+    base = secure_filename(file_storage.filename)
+    stored = f"{ts}_{base}"
+    n = 1
+    while os.path.exists(os.path.join(uploads_dir, stored)):
+        # mismo nombre en el mismo segundo (p.ej. dentro de un lote): no pisar el anterior
+        stored = f"{ts}_{n}_{base}"
+        n += 1
     full = os.path.join(uploads_dir, stored)
     os.makedirs(uploads_dir, exist_ok=True)
-    file_storage.save(full)
-    return stored, full
+    h = hashlib.sha256()
+    tmp = full + ".part"
+    src = file_storage.stream
+    try:
+        with open(tmp, "wb", buffering=0) as out:
+            for chunk in iter(lambda: src.read(bufsize), b""):
+                h.update(chunk)
+                out.write(chunk)
+        os.replace(tmp, full)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return stored, full, h.hexdigest()
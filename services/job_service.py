@@ -0,0 +1,198 @@
+# services/job_service.py
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from mongo import get_db
+from services import metrics
+
+# Pool acotado de trabajos de mezcla (FFmpeg/librosa/Audiostack fuera del request HTTP)
+MIX_WORKERS = int(os.getenv("MIX_WORKERS") or 2)
+MIX_MAX_PENDING = int(os.getenv("MIX_MAX_PENDING") or 16)
+JOB_TTL_SEC = int(os.getenv("MIX_JOB_TTL_SEC") or 3600)
+# Cada cuánto mira un worker si le han cancelado (desde otro worker) alguno de sus trabajos
+JOB_CANCEL_POLL_SEC = float(os.getenv("MIX_JOB_CANCEL_POLL_SEC") or 1.0)
+# El progreso se escribe en Mongo como mucho cada tanto (FFmpeg lo informa varias veces por segundo)
+_PROGRESS_EVERY_SEC = 0.5
+_PURGE_EVERY_SEC = 60
+
+PENDIENTE, PROCESANDO, LISTO, ERROR, CANCELADO = "pendiente", "procesando", "listo", "error", "cancelado"
+TERMINADOS = (LISTO, ERROR, CANCELADO)
+
+log = logging.getLogger(__name__)
+
+# El estado de los trabajos vive en la colección mixJobs: con varios workers de Gunicorn, la consulta
+# de estado o la cancelación pueden llegar a un worker distinto del que ejecuta la mezcla.
+# En memoria sólo queda lo que es del proceso que ejecuta: el Event de cancelación de sus trabajos.
+_lock = threading.Lock()
+_local = {}  # job_id -> {"cancel": Event, "creado": float, "progreso_ts": float}
+_executor = None
+_executor_pid = None
+_on_expire = None
+_last_purge = {"ts": 0.0}
+
+
+class ColaLlena(Exception):
+    """No se aceptan más trabajos hasta que se libere la cola."""
+
+
+def _jobs():
+    return get_db().mixJobs
+
+
+def _get_executor():
+    # Se crea perezosamente y de nuevo tras un fork (los hilos no sobreviven al fork)
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=MIX_WORKERS, thread_name_prefix="mix")
+        _executor_pid = os.getpid()
+        _local.clear()
+        threading.Thread(target=_watch_cancels, name="mix-cancel", daemon=True).start()
+    return _executor
+
+
+def on_expire(fn):
+    """Registra fn(job), llamada al olvidar un trabajo caducado (p.ej. para borrar su salida)."""
+    global _on_expire
+    _on_expire = fn
+
+
+def _purge_expired(force=False):
+    """Olvida trabajos terminados hace más de JOB_TTL_SEC y llama a on_expire (como mucho una vez por minuto)."""
+    now = time.time()
+    if not force and now - _last_purge["ts"] < _PURGE_EVERY_SEC:
+        return
+    _last_purge["ts"] = now
+    for job in _jobs().find({"estado": {"$in": list(TERMINADOS)}, "terminado": {"$lt": now - JOB_TTL_SEC}}):
+        # Sólo limpia quien consigue borrarlo (otro worker puede estar purgando a la vez)
+        if _jobs().delete_one({"_id": job["_id"]}).deleted_count and _on_expire is not None:
+            try:
+                _on_expire(job)
+            except Exception:
+                log.exception("Limpieza del trabajo %s", job["_id"])
+
+
+def submit(fn, owner=None):
+    """
+    Encola fn(job_id) -> archivo y devuelve el id del trabajo.
+    fn puede informar de su avance con progress(job_id, %) y consultar cancel_event(job_id).
+    Lanza ColaLlena si este worker tiene MIX_MAX_PENDING trabajos sin terminar.
+    """
+    _purge_expired()
+    with _lock:
+        executor = _get_executor()
+        if len(_local) >= MIX_MAX_PENDING:
+            metrics.event("job_rejected")
+            raise ColaLlena("Hay demasiadas mezclas en proceso. Inténtalo en unos segundos.")
+        job_id = uuid.uuid4().hex
+        creado = time.time()
+        _local[job_id] = {"cancel": threading.Event(), "creado": creado, "progreso_ts": 0.0}
+    try:
+        _jobs().insert_one({
+            "_id": job_id, "owner": owner, "estado": PENDIENTE,
+            "archivo": None, "mensaje": None, "progreso": 0.0,
+            "creado": creado, "terminado": None, "cancelar": False,
+        })
+    except Exception:
+        with _lock:
+            _local.pop(job_id, None)
+        raise
+    executor.submit(_run, job_id, fn)
+    return job_id
+
+
+def _run(job_id, fn):
+    cancel = cancel_event(job_id)
+    if cancel is not None and cancel.is_set():
+        _finish(job_id, CANCELADO)
+        return
+    metrics.observe("harmonymix_job_queue_seconds", time.time() - _local[job_id]["creado"])
+    _update(job_id, estado=PROCESANDO)
+    try:
+        archivo = fn(job_id)
+        _finish(job_id, LISTO, archivo=archivo, progreso=100.0)
+    except Exception as e:
+        if cancel is not None and cancel.is_set():
+            _finish(job_id, CANCELADO)
+            return
+        log.error("ERROR al mezclar (job %s): %s", job_id, e)
+        _finish(job_id, ERROR, mensaje=str(e))
+
+
+def _finish(job_id, estado, **fields):
+    metrics.event(f"job_{estado}")
+    try:
+        _update(job_id, estado=estado, terminado=time.time(), **fields)
+    finally:
+        with _lock:
+            _local.pop(job_id, None)
+
+
+def _watch_cancels():
+    """Hilo por proceso: traslada las cancelaciones pedidas en otros workers al Event local."""
+    pid = os.getpid()
+    while _executor_pid == pid:
+        time.sleep(JOB_CANCEL_POLL_SEC)
+        with _lock:
+            ids = [jid for jid, job in _local.items() if not job["cancel"].is_set()]
+        if not ids:
+            continue
+        try:
+            for job in _jobs().find({"_id": {"$in": ids}, "cancelar": True}, {"_id": 1}):
+                with _lock:
+                    local = _local.get(job["_id"])
+                if local is not None:
+                    local["cancel"].set()
+        except Exception as e:
+            log.warning("No se pudieron consultar las cancelaciones: %s", e)
+
+
+def progress(job_id, percent):
+    with _lock:
+        local = _local.get(job_id)
+        now = time.time()
+        if local is None or now - local["progreso_ts"] < _PROGRESS_EVERY_SEC:
+            return
+        local["progreso_ts"] = now
+    _update(job_id, progreso=round(float(percent), 1))
+
+
+def cancel_event(job_id):
+    """Event que se activa al cancelar el trabajo (None si no se ejecuta en este proceso)."""
+    with _lock:
+        job = _local.get(job_id)
+        return job["cancel"] if job is not None else None
+
+
+def cancel(job_id, owner=None) -> bool:
+    """
+    Pide la cancelación de un trabajo pendiente o en curso, esté en el worker que esté. El que está
+    en curso termina en cuanto su proceso FFmpeg se detiene. Devuelve False si no existe o ya había terminado.
+    """
+    query = {"_id": job_id, "estado": {"$nin": list(TERMINADOS)}}
+    if owner is not None:
+        query["owner"] = owner
+    if not _jobs().update_one(query, {"$set": {"cancelar": True}}).matched_count:
+        return False
+    event = cancel_event(job_id)
+    if event is not None:
+        event.set()
+    return True
+
+
+def _update(job_id, **fields):
+    _jobs().update_one({"_id": job_id}, {"$set": fields})
+
+
+def get(job_id, owner=None):
+    """Copia pública del estado del trabajo, o None si no existe / no pertenece a owner."""
+    _purge_expired()
+    job = _jobs().find_one({"_id": job_id}, {"cancelar": 0})
+    if job is None or (owner is not None and job["owner"] != owner):
+        return None
+    job["id"] = job.pop("_id")
+    job.pop("owner", None)
+    return job
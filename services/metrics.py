@@ -0,0 +1,206 @@
+# services/metrics.py
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Métricas en memoria del proceso, expuestas en formato de texto de Prometheus (GET /metrics):
+#   harmonymix_stage_seconds      histograma por etapa (span) y resultado (ok | error)
+#   harmonymix_http_request_seconds  histograma por endpoint, método y código
+#   harmonymix_events_total       contadores sueltos (aciertos de caché, reintentos...)
+# Con varios workers de Gunicorn cada uno expone lo suyo (Prometheus los agrega por instancia).
+#
+# Traza por petición: si existe el archivo METRICS_TRACE_FILE (p.ej. `touch trace.on`), cada span se
+# registra en el logger "harmonymix.trace" con el id de la petición o del trabajo. Se activa y
+# desactiva sin reiniciar: el archivo se comprueba como mucho una vez por segundo.
+METRICS_TRACE_FILE = os.getenv("METRICS_TRACE_FILE") or "trace.on"
+METRICS_TOKEN = (os.getenv("METRICS_TOKEN") or "").strip()
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+trace_log = logging.getLogger("harmonymix.trace")
+
+_lock = threading.Lock()
+_histograms = {}  # (métrica, labels ordenadas) -> [conteos por bucket..., suma, total]
+_counters = {}    # (métrica, labels ordenadas) -> valor
+_ctx = threading.local()
+_trace_flag = {"checked": 0.0, "on": False}
+
+
+def _key(metric, labels):
+    return metric, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def observe(metric: str, seconds: float, **labels):
+    key = _key(metric, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, le in enumerate(BUCKETS):
+            if seconds <= le:
+                h[i] += 1
+        h[-2] += seconds
+        h[-1] += 1
+
+
+def inc(metric: str, value: float = 1, **labels):
+    key = _key(metric, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def event(name: str, value: float = 1):
+    """Contador genérico: harmonymix_events_total{event=name}."""
+    inc("harmonymix_events_total", value, event=name)
+
+
+# -------------------- Traza --------------------
+def tracing() -> bool:
+    now = time.monotonic()
+    if now - _trace_flag["checked"] > 1.0:
+        _trace_flag["on"] = os.path.exists(METRICS_TRACE_FILE)
+        _trace_flag["checked"] = now
+    return _trace_flag["on"]
+
+
+@contextmanager
+def trace_context(trace_id=None):
+    """Id de traza para los spans de este hilo (una petición HTTP o un trabajo en segundo plano)."""
+    prev = getattr(_ctx, "trace", None)
+    _ctx.trace = [trace_id or uuid.uuid4().hex[:12], 0]  # id, profundidad
+    try:
+        yield _ctx.trace[0]
+    finally:
+        _ctx.trace = prev
+
+
+# -------------------- Spans --------------------
+@contextmanager
+def span(stage: str, **labels):
+    """Mide el bloque como etapa `stage` (histograma harmonymix_stage_seconds)."""
+    trace = getattr(_ctx, "trace", None)
+    if trace is not None:
+        trace[1] += 1
+    t0 = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        observe("harmonymix_stage_seconds", elapsed, stage=stage, outcome=outcome, **labels)
+        collect = getattr(_ctx, "collect", None)
+        if collect is not None:
+            collect.append((stage, labels, elapsed, outcome))
+        if trace is not None:
+            trace[1] -= 1
+            if tracing():
+                extra = "".join(f" {k}={v}" for k, v in labels.items())
+                trace_log.info("trace=%s %s%s %.1fms %s%s", trace[0], "  " * trace[1], stage,
+                               elapsed * 1000, outcome, extra)
+
+
+def timed(stage: str):
+    """Decorador equivalente a `with span(stage)` alrededor de toda la función."""
+    def decorator(fn):
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        wrapper.__name__, wrapper.__doc__, wrapper.__wrapped__ = fn.__name__, fn.__doc__, fn
+        return wrapper
+    return decorator
+
+
+# -------------------- Procesos del pool de análisis --------------------
+def collected(fn, *args, **kwargs):
+    """
+    Se ejecuta en el proceso hijo: devuelve (resultado, spans medidos) para que el padre
+    los incorpore con merge() (las métricas del hijo no se verían en /metrics).
+    """
+    _ctx.collect = []
+    try:
+        result = fn(*args, **kwargs)
+        return result, _ctx.collect
+    finally:
+        _ctx.collect = None
+
+
+def merge(samples):
+    for stage, labels, elapsed, outcome in samples or ():
+        observe("harmonymix_stage_seconds", elapsed, stage=stage, outcome=outcome, **labels)
+
+
+# -------------------- Exposición --------------------
+def _fmt_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+
+def render() -> str:
+    """Todas las métricas en formato de texto de Prometheus 0.0.4."""
+    with _lock:
+        histograms = {k: list(v) for k, v in _histograms.items()}
+        counters = dict(_counters)
+    lines = []
+    for metric in sorted({m for m, _ in histograms}):
+        lines.append(f"# TYPE {metric} histogram")
+        for (m, labels), h in sorted(histograms.items()):
+            if m != metric:
+                continue
+            for i, le in enumerate(BUCKETS):
+                lines.append(f"{metric}_bucket{_fmt_labels(labels, [('le', repr(le))])} {h[i]}")
+            lines.append(f"{metric}_bucket{_fmt_labels(labels, [('le', '+Inf')])} {h[-1]}")
+            lines.append(f"{metric}_sum{_fmt_labels(labels)} {h[-2]:.6f}")
+            lines.append(f"{metric}_count{_fmt_labels(labels)} {h[-1]}")
+    for metric in sorted({m for m, _ in counters}):
+        lines.append(f"# TYPE {metric} counter")
+        for (m, labels), v in sorted(counters.items()):
+            if m == metric:
+                lines.append(f"{metric}{_fmt_labels(labels)} {v:g}")
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app):
+    """Mide cada petición (endpoint, método, código), abre su traza y registra GET /metrics."""
+    from flask import Response, g, request
+
+    if not trace_log.handlers and not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO)
+    trace_log.setLevel(logging.INFO)
+
+    @app.before_request
+    def _metrics_start():
+        g._metrics_t0 = time.perf_counter()
+        g._metrics_trace = trace_context(request.headers.get("X-Request-Id"))
+        g._metrics_trace.__enter__()
+
+    @app.teardown_request
+    def _metrics_end(exc):
+        trace = g.pop("_metrics_trace", None)
+        if trace is not None:
+            trace.__exit__(None, None, None)
+
+    @app.after_request
+    def _metrics_observe(resp):
+        t0 = g.pop("_metrics_t0", None)
+        if t0 is not None and request.endpoint != "metrics":
+            elapsed = time.perf_counter() - t0
+            observe("harmonymix_http_request_seconds", elapsed,
+                    endpoint=request.endpoint or "404", method=request.method, status=resp.status_code)
+            if tracing():
+                trace_log.info("trace=%s %s %s -> %s %.1fms", getattr(_ctx, "trace", ["-"])[0],
+                               request.method, request.path, resp.status_code, elapsed * 1000)
+        return resp
+
+    @app.route("/metrics", endpoint="metrics")
+    def _metrics():
+        if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+            return Response("forbidden\n", status=403, mimetype="text/plain")
+        return Response(render(), mimetype="text/plain; version=0.0.4")
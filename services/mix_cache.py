@@ -0,0 +1,101 @@
+# services/mix_cache.py
+import functools
+import hashlib
+import json
+import os
+import threading
+
+from services.file_utils import sha256_fileobj
+
+# Caché en disco de mezclas renderizadas, direccionada por contenido:
+#   clave = sha256(hashes de las pistas en orden + modo + parámetros efectivos)
+CACHE_DIR = "cache"
+MIX_CACHE_MAX_MB = int(os.getenv("MIX_CACHE_MAX_MB") or 1024)
+# Hashes memorizados (LRU): las entradas de archivos borrados o cambiados acaban saliendo solas
+HASH_MEMO_SIZE = 4096
+
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return MIX_CACHE_MAX_MB > 0
+
+
+def file_sha256(path: str) -> str:
+    """sha256 del archivo, memorizado por (ruta, tamaño, mtime) para no releerlo en cada mezcla."""
+    st = os.stat(path)
+    return _file_sha256(path, st.st_size, st.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=HASH_MEMO_SIZE)
+def _file_sha256(path: str, size: int, mtime_ns: int) -> str:
+    with open(path, "rb") as f:
+        return sha256_fileobj(f)
+
+
+def cache_key(input_hashes, mode: str, params: dict) -> str:
+    payload = json.dumps({"inputs": list(input_hashes), "mode": mode, "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def features_digest(features) -> str:
+    """
+    Resumen de lo que el modo smart toma de cada pista (bpm, tonalidad, rejilla de beats), en orden.
+    Va en los parámetros de la clave: si el análisis de una pista cambia (p.ej. se completa y gana
+    beatGrid), la mezcla guardada con el análisis anterior deja de servirse.
+    """
+    payload = [[f.get("bpm"), f.get("musicalKey"), f.get("beatGrid")] for f in features]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _name(key: str) -> str:
+    return f"{CACHE_DIR}/{key}.mp3"
+
+
+def lookup(uploads_dir: str, key: str):
+    """Devuelve el nombre (relativo a uploads) si la mezcla está en caché; marca el uso para el LRU."""
+    name = _name(key)
+    path = os.path.join(uploads_dir, name)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return name
+
+
+def store(uploads_dir: str, key: str, produced_name: str) -> str:
+    """Mueve la mezcla producida a la caché y aplica el límite de tamaño. Devuelve el nombre en caché."""
+    name = _name(key)
+    dest = os.path.join(uploads_dir, name)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    os.replace(os.path.join(uploads_dir, produced_name), dest)
+    evict(os.path.dirname(dest), MIX_CACHE_MAX_MB * 1024 * 1024, keep=dest)
+    return name
+
+
+def evict(cache_dir: str, max_bytes: int, keep: str = None, suffixes=(".mp3",)):
+    """
+    Expulsa las entradas menos usadas recientemente (mtime) hasta quedar bajo max_bytes.
+    Sólo cuentan los archivos con alguna de `suffixes`; `keep` no se expulsa nunca (la recién escrita).
+    También la usa la caché de exportación (export_service) sobre su propio directorio.
+    """
+    with _lock:
+        entries = []
+        for entry in os.scandir(cache_dir):
+            # Los archivos auxiliares (p.ej. .peaks) se van con su mezcla
+            if entry.is_file() and entry.name.endswith(tuple(suffixes)):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+            if os.path.exists(path + ".peaks"):
+                os.remove(path + ".peaks")
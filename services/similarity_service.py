@@ -0,0 +1,164 @@
+# services/similarity_service.py
+import os
+import threading
+import time
+
+# Búsqueda de pistas parecidas (timbre + armonía) sobre una matriz NumPy por usuario.
+# Vector por pista = mfccMean (13) + chromaMean (12), estandarizado por columna en la biblioteca.
+SIMILARITY_TTL_SEC = int(os.getenv("SIMILARITY_TTL_SEC") or 300)
+N_DIMS = 25
+
+_lock = threading.Lock()
+_libraries = {}  # userId -> _Library
+
+
+def _vector(feats):
+    import numpy as np
+    mfcc, chroma = feats.get("mfccMean"), feats.get("chromaMean")
+    if not mfcc or not chroma or len(mfcc) + len(chroma) != N_DIMS:
+        return None
+    return np.asarray(list(mfcc) + list(chroma), dtype=np.float32)
+
+
+class _Library:
+    """Matriz de features de un usuario; las altas/bajas se aplican sin recargar de Mongo."""
+
+    def __init__(self):
+        import numpy as np
+        self.ids = []
+        self.info = []  # (storedName, originalName, bpm, musicalKey)
+        self.bpm = np.empty(0, dtype=np.float32)
+        self.raw = np.empty((0, N_DIMS), dtype=np.float32)
+        self.loaded_at = time.time()
+        self._norm = None  # (estandarizada, estandarizada y L2-normalizada), se recalcula al cambiar
+        self._pos = None   # trackId -> fila
+
+    def position(self, track_id):
+        if self._pos is None:
+            self._pos = {tid: i for i, tid in enumerate(self.ids)}
+        return self._pos.get(track_id)
+
+    def add(self, track_id, stored_name, original_name, feats):
+        import numpy as np
+        vec = _vector(feats)
+        if vec is None:
+            return
+        self.remove(track_id)
+        self.ids.append(track_id)
+        self.info.append((stored_name, original_name, float(feats.get("bpm") or 0), feats.get("musicalKey")))
+        self.bpm = np.append(self.bpm, np.float32(feats.get("bpm") or 0))
+        self.raw = np.vstack([self.raw, vec[None, :]])
+        self._norm = self._pos = None
+
+    def remove(self, track_id):
+        import numpy as np
+        i = self.position(track_id)
+        if i is None:
+            return
+        del self.ids[i]
+        del self.info[i]
+        self.bpm = np.delete(self.bpm, i)
+        self.raw = np.delete(self.raw, i, axis=0)
+        self._norm = self._pos = None
+
+    def normalized(self):
+        import numpy as np
+        if self._norm is None:
+            std = self.raw.std(axis=0)
+            z = (self.raw - self.raw.mean(axis=0)) / np.where(std > 1e-9, std, 1.0)
+            unit = z / np.maximum(np.linalg.norm(z, axis=1, keepdims=True), 1e-9)
+            self._norm = (z, unit)
+        return self._norm
+
+
+def _load(db, user_id):
+    """Carga la biblioteca completa construyendo las matrices de una vez (no fila a fila)."""
+    import numpy as np
+    lib = _Library()
+    tracks = {t["_id"]: t for t in db.tracks.find({"userId": user_id}, {"storedName": 1, "originalName": 1})}
+    rows, bpms = [], []
+    for f in db.trackFeatures.find(
+        {"trackId": {"$in": list(tracks)}},
+        {"trackId": 1, "bpm": 1, "musicalKey": 1, "mfccMean": 1, "chromaMean": 1},
+    ):
+        vec = _vector(f)
+        if vec is None:
+            continue
+        t = tracks[f["trackId"]]
+        bpm = float(f.get("bpm") or 0)
+        lib.ids.append(t["_id"])
+        lib.info.append((t.get("storedName"), t.get("originalName"), bpm, f.get("musicalKey")))
+        rows.append(vec)
+        bpms.append(bpm)
+    if rows:
+        lib.raw = np.vstack(rows)
+        lib.bpm = np.asarray(bpms, dtype=np.float32)
+    return lib
+
+
+def _library(db, user_id):
+    with _lock:
+        lib = _libraries.get(user_id)
+        if lib is not None and time.time() - lib.loaded_at < SIMILARITY_TTL_SEC:
+            return lib
+    # La carga va fuera del lock: una biblioteca grande no bloquea al resto de usuarios
+    lib = _load(db, user_id)
+    with _lock:
+        _libraries[user_id] = lib
+    return lib
+
+
+def track_added(user_id, track_id, stored_name, original_name, feats):
+    """Alta incremental (sólo si la biblioteca del usuario ya está en memoria)."""
+    with _lock:
+        lib = _libraries.get(user_id)
+        if lib is not None:
+            lib.add(track_id, stored_name, original_name, feats)
+
+
+def track_removed(user_id, track_id):
+    """Baja incremental (sólo si la biblioteca del usuario ya está en memoria)."""
+    with _lock:
+        lib = _libraries.get(user_id)
+        if lib is not None:
+            lib.remove(track_id)
+
+
+def similar_tracks(db, user_id, track_id, k=10, metric="cosine", bpm_tol=None):
+    """
+    Las k pistas del usuario más parecidas a track_id.
+    metric: "cosine" | "euclidean". bpm_tol: si se indica, sólo pistas con |ΔBPM| <= bpm_tol.
+    Devuelve [{trackId, storedName, originalName, bpm, musicalKey, distance}] de menor a mayor distancia.
+    """
+    import numpy as np
+    lib = _library(db, user_id)
+    with _lock:
+        q = lib.position(track_id)
+        if q is None:
+            return None
+        z, unit = lib.normalized()
+        bpm, ids, info = lib.bpm, list(lib.ids), list(lib.info)
+
+    if metric == "euclidean":
+        dist = np.linalg.norm(z - z[q], axis=1)
+    else:
+        dist = 1.0 - unit @ unit[q]
+
+    mask = np.ones(len(ids), dtype=bool)
+    mask[q] = False
+    if bpm_tol is not None:
+        mask &= np.abs(bpm - bpm[q]) <= bpm_tol
+    candidates = np.flatnonzero(mask)
+    if candidates.size == 0:
+        return []
+
+    k = min(k, candidates.size)
+    top = candidates[np.argpartition(dist[candidates], k - 1)[:k]]
+    top = top[np.argsort(dist[top])]
+    return [
+        {
+            "trackId": ids[i], "storedName": info[i][0], "originalName": info[i][1],
+            "bpm": info[i][2], "musicalKey": info[i][3], "distance": float(dist[i]),
+        }
+        for i in top
+    ]
@@ -0,0 +1,119 @@
+# services/waveform_service.py
+import os
+import struct
+import uuid
+
+# Picos min/max precalculados para dibujar formas de onda sin descargar el audio.
+# Archivo "<audio>.peaks" junto al audio:
+#   cabecera  b"HMPK" | versión u8 | nº niveles u8 | sample rate u32 | (muestras/pico u32, nº picos u32) * niveles
+#   datos     por nivel, pares int8 (min, max) intercalados
+PEAKS_EXT = ".peaks"
+PEAKS_LEVELS = (256, 1024, 4096, 16384)  # muestras por pico, de más a menos detalle
+_MAGIC = b"HMPK"
+_VERSION = 1
+_BLOCK_FRAMES = 256 * 1024
+
+
+def peaks_path(audio_path: str) -> str:
+    return audio_path + PEAKS_EXT
+
+
+def _finest_peaks(audio_path: str):
+    """Min/max por cada PEAKS_LEVELS[0] muestras, leyendo por bloques (memoria acotada)."""
+    import numpy as np
+    import soundfile as sf
+    spp = PEAKS_LEVELS[0]
+    mins, maxs = [], []
+    try:
+        with sf.SoundFile(audio_path) as f:
+            sr = f.samplerate
+            rest = np.empty(0, dtype=np.float32)
+            for block in f.blocks(blocksize=_BLOCK_FRAMES, dtype="float32", always_2d=True):
+                mono = np.concatenate([rest, block.mean(axis=1)])
+                usable = len(mono) - len(mono) % spp
+                frames = mono[:usable].reshape(-1, spp)
+                mins.append(frames.min(axis=1))
+                maxs.append(frames.max(axis=1))
+                rest = mono[usable:]
+            if len(rest):
+                mins.append(rest.min(keepdims=True))
+                maxs.append(rest.max(keepdims=True))
+    except sf.LibsndfileError:
+        # Formatos que libsndfile no lee (m4a/aac): decodificación completa como último recurso
+        import librosa
+        y, sr = librosa.load(audio_path, sr=None, mono=True)
+        pad = (-len(y)) % spp
+        frames = np.pad(y, (0, pad)).reshape(-1, spp)
+        mins, maxs = [frames.min(axis=1)], [frames.max(axis=1)]
+    if not mins:
+        return sr, np.empty(0, dtype=np.float32), np.empty(0, dtype=np.float32)
+    return sr, np.concatenate(mins), np.concatenate(maxs)
+
+
+def generate_peaks(audio_path: str) -> str:
+    """Genera (o regenera) el archivo de picos de audio_path y devuelve su ruta."""
+    import numpy as np
+    sr, mn, mx = _finest_peaks(audio_path)
+    levels = []
+    for spp in PEAKS_LEVELS:
+        factor = spp // PEAKS_LEVELS[0]
+        pad = (-len(mn)) % factor
+        lmin = np.pad(mn, (0, pad), mode="edge").reshape(-1, factor).min(axis=1) if len(mn) else mn
+        lmax = np.pad(mx, (0, pad), mode="edge").reshape(-1, factor).max(axis=1) if len(mx) else mx
+        pairs = np.empty(2 * len(lmin), dtype=np.int8)
+        pairs[0::2] = np.clip(np.round(lmin * 127), -128, 127)
+        pairs[1::2] = np.clip(np.round(lmax * 127), -128, 127)
+        levels.append((spp, pairs))
+
+    header = _MAGIC + struct.pack("<BBI", _VERSION, len(levels), sr)
+    header += b"".join(struct.pack("<II", spp, len(pairs) // 2) for spp, pairs in levels)
+    out = peaks_path(audio_path)
+    tmp = f"{out}.{uuid.uuid4().hex}.part"  # único: la subida y una lectura pueden generarlo a la vez
+    try:
+        with open(tmp, "wb") as f:
+            f.write(header)
+            for _, pairs in levels:
+                f.write(pairs.tobytes())
+        os.replace(tmp, out)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return out
+
+
+def generate_peaks_async(audio_path: str):
+    """Genera los picos en el pool de análisis sin bloquear la petición."""
+    from services.feature_service import submit
+    return submit(generate_peaks, audio_path)
+
+
+def remove_peaks(audio_path: str):
+    try:
+        os.remove(peaks_path(audio_path))
+    except OSError:
+        pass
+
+
+def read_level(audio_path: str, level: int):
+    """
+    Devuelve (sample_rate, muestras_por_pico, bytes int8 min/max intercalados) del nivel pedido.
+    Genera el archivo de picos si todavía no existe (p.ej. pistas antiguas).
+    """
+    path = peaks_path(audio_path)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(audio_path):
+        generate_peaks(audio_path)
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != _MAGIC:
+        raise ValueError("Archivo de picos no válido.")
+    _, n_levels, sr = struct.unpack_from("<BBI", data, 4)
+    level = max(0, min(level, n_levels - 1))
+    offset = 10 + 8 * n_levels
+    for i in range(n_levels):
+        spp, count = struct.unpack_from("<II", data, 10 + 8 * i)
+        if i == level:
+            return sr, spp, data[offset:offset + 2 * count]
+        offset += 2 * count